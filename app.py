@@ -1,27 +1,80 @@
 import os
 import logging
-from flask import Flask, request, jsonify
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import runpy
+from flask import Flask, request, jsonify, session
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from werkzeug.exceptions import HTTPException
+from urllib3.util.retry import Retry
 import base64
 from datetime import datetime, timedelta
 import hashlib
 import hmac
+import secrets
 from urllib.parse import urlencode
 import re
+import string
+from types import MappingProxyType
+from http import HTTPStatus
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import time
+from functools import lru_cache
+from cachetools import TTLCache, cached
 
 # Load environment variables
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson - used by request.get_json() and jsonify()"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class LazyJson:
+    """Log argument that is only serialised to indented JSON if the record is actually emitted"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return orjson.dumps(self.data, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Configuration from environment variables
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-default-secret-key')
+FLASK_ENV = os.getenv('FLASK_ENV', 'production')
+DEBUG_MODE = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
 FRESHDESK_DOMAIN = os.getenv('FRESHDESK_DOMAIN')
 FRESHDESK_API_KEY = os.getenv('FRESHDESK_API_KEY')
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode() if WEBHOOK_SECRET else b''
+
+# Freshdesk API endpoints (domain is fixed for the life of the process)
+_FRESHDESK_BASE = f"https://{FRESHDESK_DOMAIN}/api/v2"
+_FD_TICKETS_URL = f"{_FRESHDESK_BASE}/tickets"
+_FD_CONTACTS_URL = f"{_FRESHDESK_BASE}/contacts"
+_FD_PING_URL = f"{_FD_TICKETS_URL}?per_page=1"
 
 # Xero configuration
 XERO_CLIENT_ID = os.getenv('XERO_CLIENT_ID')
@@ -31,9 +84,17 @@ XERO_SCOPE = os.getenv('XERO_SCOPE')
 XERO_ACCESS_TOKEN = os.getenv('XERO_ACCESS_TOKEN')
 
 # Other configuration
-ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', '').split(',') if os.getenv('ALLOWED_ORIGINS') else []
+ALLOWED_ORIGINS = frozenset(os.getenv('ALLOWED_ORIGINS', '').split(',')) if os.getenv('ALLOWED_ORIGINS') else frozenset()
 NOTIFICATION_EMAIL = os.getenv('NOTIFICATION_EMAIL')
 BASE_URL = os.getenv('BASE_URL', 'http://localhost:5001')
+GUNICORN_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+HEALTH_CACHE_TTL = int(os.getenv('HEALTH_CACHE_TTL', 30))
+CONTACT_CACHE_SIZE = int(os.getenv('CONTACT_CACHE_SIZE', 10000))
+CONTACT_CACHE_TTL = int(os.getenv('CONTACT_CACHE_TTL', 3600))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 10000))
+INVOICE_BATCH_SIZE = int(os.getenv('INVOICE_BATCH_SIZE', 50))
+INVOICE_BATCH_MAX_WAIT = float(os.getenv('INVOICE_BATCH_MAX_WAIT', 1.0))
 
 # WordPress Form Configuration
 WP_FORM_ID = os.getenv('WP_FORM_ID', '107')
@@ -51,18 +112,90 @@ log_dir = os.path.dirname(os.getenv('LOG_FILE', 'logs/app.log'))
 if log_dir:
     os.makedirs(log_dir, exist_ok=True)
 
+# Request threads only enqueue records; a background listener does the file/console I/O
+_log_queue = queue.SimpleQueue()
+_log_targets = (
+    logging.FileHandler(os.getenv('LOG_FILE', 'logs/app.log')),
+    logging.StreamHandler()
+)
+_log_listener = None
+
+
+def _start_log_listener():
+    """Start (or restart in a forked worker) the thread that drains the log queue"""
+    global _log_listener
+    _log_listener = QueueListener(_log_queue, *_log_targets)
+    _log_listener.start()
+
+
 logging.basicConfig(
     level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO')),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.getenv('LOG_FILE', 'logs/app.log')),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(_log_queue)]
 )
+_start_log_listener()
+atexit.register(lambda: _log_listener.stop())
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_start_log_listener)
 logger = logging.getLogger(__name__)
 
-# Base64 encode API key for Freshdesk authentication
-freshdesk_auth = base64.b64encode(f"{FRESHDESK_API_KEY}:X".encode()).decode() if FRESHDESK_API_KEY else ""
+# Freshdesk request headers, applied once to the shared Freshdesk session
+FRESHDESK_HEADERS = MappingProxyType({
+    "Content-Type": "application/json"
+})
+
+class BoundedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that caps in-flight requests; extra callers wait instead of tripping Freshdesk's rate limit"""
+
+    def __init__(self, max_in_flight, **kwargs):
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        with self._in_flight:
+            return super().send(request, **kwargs)
+
+
+def build_session(max_in_flight, pool_maxsize):
+    """Pooled keep-alive HTTPS session; retries only apply to idempotent methods"""
+    session = requests.Session()
+    session.mount('https://', BoundedHTTPAdapter(
+        max_in_flight=max_in_flight,
+        pool_connections=20,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 502, 503, 504],
+            respect_retry_after_header=True
+        )
+    ))
+    return session
+
+
+# Shared HTTP sessions - keep-alive connections are reused across requests instead of
+# paying a new TCP + TLS handshake on every call. Xero gets its own session so the
+# Freshdesk auth and headers never leak into Xero calls.
+SESSION = build_session(int(os.getenv('FRESHDESK_MAX_CONCURRENCY', 10)), pool_maxsize=50)
+SESSION.headers.update(FRESHDESK_HEADERS)
+XERO_SESSION = build_session(10, pool_maxsize=10)
+
+# Freshdesk uses HTTP basic auth with the API key as username and a dummy password
+if FRESHDESK_API_KEY:
+    SESSION.auth = (FRESHDESK_API_KEY, 'X')
+
+# Background threads for Freshdesk calls that can overlap with the request thread's own call
+FRESHDESK_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv('FRESHDESK_EXECUTOR_WORKERS', 8)),
+    thread_name_prefix='freshdesk'
+)
+
+# Email validation - compiled once; \Z (not $) so a trailing newline is rejected
+MAX_EMAIL_LENGTH = 254
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\Z')
+
+# Values that only say whether a password was given, not the password itself
+_PASSWORD_STATUS_WORDS = frozenset({'yes', 'no', 'provided', 'not provided', 'true', 'false'})
 
 
 def verify_webhook_signature(payload, signature):
@@ -72,17 +205,21 @@ def verify_webhook_signature(payload, signature):
         return True
 
     try:
-        expected_signature = hmac.new(
-            WEBHOOK_SECRET.encode(),
-            payload,
-            hashlib.sha256
-        ).hexdigest()
-
         # Remove possible prefix
         if signature.startswith('sha256='):
             signature = signature[7:]
 
-        return hmac.compare_digest(signature, expected_signature)
+        # A SHA-256 hex digest is always 64 characters
+        if len(signature) != 64:
+            return False
+
+        try:
+            provided_signature = bytes.fromhex(signature)
+        except ValueError:
+            return False
+
+        expected_signature = hmac.new(WEBHOOK_SECRET_BYTES, payload, hashlib.sha256).digest()
+        return hmac.compare_digest(provided_signature, expected_signature)
     except Exception as e:
         logger.error(f"Signature verification error: {str(e)}")
         return False
@@ -90,44 +227,69 @@ def verify_webhook_signature(payload, signature):
 
 def validate_email(email):
     """Validate email format"""
-    if not email:
+    if not email or len(email) > MAX_EMAIL_LENGTH:
         return False
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    return _EMAIL_RE.match(email) is not None
+
+
+@lru_cache(maxsize=1)
+def _iso_second(second):
+    return datetime.fromtimestamp(second).isoformat()
+
+
+def iso_now():
+    """Local ISO timestamp (second resolution), formatted at most once per second"""
+    return _iso_second(int(time.time()))
+
+
+def prebuild_timestamped_json(data):
+    """Serialise a static response body once; returns (prefix, suffix) around a trailing timestamp"""
+    body = orjson.dumps(data)
+    return body[:-1] + b',"timestamp":"', b'"}\n'
+
+
+def timestamped_json_response(prefix, suffix):
+    """Build a JSON response from a prebuilt body, splicing in the current timestamp"""
+    return app.response_class(
+        prefix + iso_now().encode() + suffix,
+        mimetype='application/json'
+    )
+
+
+_HOME_PREFIX, _HOME_SUFFIX = prebuild_timestamped_json({
+    "message": "1Cyber Equipment Repair - Freshdesk Integration System",
+    "status": "running",
+    "version": "1.3.0",
+    "environment": FLASK_ENV,
+    "company": "1Cyber Computer Services",
+    "endpoints": {
+        "wordpress_webhook": "/webhook/wordpress",
+        "freshdesk_webhook": "/webhook/freshdesk",
+        "xero_auth": "/xero/auth",
+        "create_ticket": "/api/tickets",
+        "create_invoice": "/api/xero/invoice",
+        "health_check": "/health",
+        "test_connection": "/test/connection"
+    },
+    "wordpress_form": {
+        "form_id": WP_FORM_ID,
+        "site_url": WP_SITE_URL
+    },
+    "features": [
+        "WordPress Form Integration",
+        "Freshdesk Ticket Creation",
+        "Simplified Password Field Mapping",
+        "Direct Password Display",
+        "Xero Invoice Generation",
+        "Comprehensive Logging"
+    ]
+})
 
 
 @app.route('/')
 def home():
     """Home endpoint"""
-    return jsonify({
-        "message": "1Cyber Equipment Repair - Freshdesk Integration System",
-        "status": "running",
-        "version": "1.3.0",
-        "environment": os.getenv('FLASK_ENV', 'production'),
-        "company": "1Cyber Computer Services",
-        "endpoints": {
-            "wordpress_webhook": "/webhook/wordpress",
-            "freshdesk_webhook": "/webhook/freshdesk",
-            "xero_auth": "/xero/auth",
-            "create_ticket": "/api/tickets",
-            "create_invoice": "/api/xero/invoice",
-            "health_check": "/health",
-            "test_connection": "/test/connection"
-        },
-        "wordpress_form": {
-            "form_id": WP_FORM_ID,
-            "site_url": WP_SITE_URL
-        },
-        "features": [
-            "WordPress Form Integration",
-            "Freshdesk Ticket Creation",
-            "Simplified Password Field Mapping",
-            "Direct Password Display",
-            "Xero Invoice Generation",
-            "Comprehensive Logging"
-        ],
-        "timestamp": datetime.now().isoformat()
-    })
+    return timestamped_json_response(_HOME_PREFIX, _HOME_SUFFIX)
 
 
 @app.route('/health')
@@ -143,7 +305,7 @@ def health_check():
                 "freshdesk": freshdesk_status,
                 "xero": "configured" if XERO_CLIENT_ID else "not_configured"
             },
-            "environment": os.getenv('FLASK_ENV', 'production'),
+            "environment": FLASK_ENV,
             "configuration": {
                 "freshdesk_domain": FRESHDESK_DOMAIN,
                 "freshdesk_api_configured": bool(FRESHDESK_API_KEY),
@@ -151,31 +313,27 @@ def health_check():
                 "allowed_origins": len(ALLOWED_ORIGINS) if ALLOWED_ORIGINS else 0,
                 "wordpress_form_id": WP_FORM_ID
             },
-            "timestamp": datetime.now().isoformat()
+            "timestamp": iso_now()
         })
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
         return jsonify({
             "status": "unhealthy",
             "error": str(e),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": iso_now()
         }), 500
 
 
+@cached(TTLCache(maxsize=1, ttl=HEALTH_CACHE_TTL), lock=threading.Lock())
 def test_freshdesk_connection():
-    """Test Freshdesk connection"""
+    """Test Freshdesk connection (result cached briefly so health polls don't hit the API)"""
     try:
         if not FRESHDESK_DOMAIN or not FRESHDESK_API_KEY:
             return "not_configured"
 
-        url = f"https://{FRESHDESK_DOMAIN}/api/v2/tickets?per_page=1"
-        headers = {
-            "Authorization": f"Basic {freshdesk_auth}",
-            "Content-Type": "application/json"
-        }
-        response = requests.get(url, headers=headers, timeout=10)
+        response = SESSION.get(_FD_PING_URL, timeout=10)
         logger.info(f"Freshdesk connection test: {response.status_code}")
-        return "connected" if response.status_code == 200 else f"error_{response.status_code}"
+        return "connected" if response.status_code == HTTPStatus.OK else f"error_{response.status_code}"
     except Exception as e:
         logger.error(f"Freshdesk connection test failed: {str(e)}")
         return "error"
@@ -188,149 +346,138 @@ def test_freshdesk_connection():
 @app.route('/webhook/wordpress', methods=['POST'])
 def wordpress_webhook():
     """Handle webhook from WordPress equipment repair form - SIMPLIFIED PASSWORD HANDLING"""
-    try:
-        # Basic CORS and origin checking
-        origin = request.headers.get('Origin')
-        user_agent = request.headers.get('User-Agent', '')
-        is_development = os.getenv('FLASK_ENV') == 'development'
-        is_test_request = 'curl' in user_agent.lower() or 'postman' in user_agent.lower()
-
-        if (not is_development and not is_test_request and
-                ALLOWED_ORIGINS and origin and origin not in ALLOWED_ORIGINS):
-            logger.warning(f"Unauthorized origin: {origin}")
-            return jsonify({"error": "Unauthorized origin"}), 403
-
-        logger.info(f"Received WordPress webhook - Origin: {origin}")
-
-        # Get form data
-        form_data = request.get_json()
-        if not form_data:
-            logger.error("No form data received")
-            return jsonify({"error": "No form data received"}), 400
-
-        # Log what we received
-        logger.info(f"Raw form data: {json.dumps(form_data, indent=2)}")
-
-        # Map WordPress field names to expected field names
-        mapped_data = map_wordpress_fields(form_data)
-
-        logger.info(f"Mapped form data: {json.dumps(mapped_data, indent=2)}")
-
-        # Validate required fields using mapped data
-        required_fields = ['contact_email', 'contact_name', 'fault_description']
-        for field in required_fields:
-            value = str(mapped_data.get(field, '')).strip()
-            logger.info(f"Checking field '{field}': '{value}'")
-            if not value:
-                logger.error(f"Missing or empty required field: {field}")
-                return jsonify({"error": f"{field} is required"}), 400
-
-        # Email validation
-        email = str(mapped_data.get('contact_email', '')).strip()
-        if not validate_email(email):
-            logger.error(f"Invalid email format: '{email}'")
-            return jsonify({"error": "Invalid email format"}), 400
-
-        # Log customer info
-        logger.info(
-            f"Customer: {mapped_data.get('contact_name')} - Equipment: {mapped_data.get('equipment_type')} {mapped_data.get('equipment_brand')}")
-
-        # Create ticket using mapped data
-        logger.info("Creating Freshdesk ticket...")
-        ticket_result = create_repair_ticket_direct(mapped_data)
-
-        if ticket_result and ticket_result.get('success'):
-            ticket_data = ticket_result.get('ticket_data', {})
-            logger.info(f"✅ Successfully created ticket: {ticket_data.get('id')}")
+    # Basic CORS and origin checking
+    origin = request.headers.get('Origin')
+    user_agent = request.headers.get('User-Agent', '')
+    is_development = FLASK_ENV == 'development'
+    ua_lower = user_agent.lower()
+    is_test_request = 'curl' in ua_lower or 'postman' in ua_lower
+
+    if (not is_development and not is_test_request and
+            ALLOWED_ORIGINS and origin and origin not in ALLOWED_ORIGINS):
+        logger.warning(f"Unauthorized origin: {origin}")
+        return jsonify({"error": "Unauthorized origin"}), 403
+
+    logger.info(f"Received WordPress webhook - Origin: {origin}")
+
+    # Get form data
+    form_data = request.get_json()
+    if not form_data:
+        logger.error("No form data received")
+        return jsonify({"error": "No form data received"}), 400
+
+    # Log what we received
+    logger.debug("Raw form data: %s", LazyJson(form_data))
+
+    # Map WordPress field names to expected field names
+    mapped_data = map_wordpress_fields(form_data)
+
+    logger.debug("Mapped form data: %s", LazyJson(mapped_data))
+
+    # Validate required fields using mapped data
+    required_fields = ['contact_email', 'contact_name', 'fault_description']
+    for field in required_fields:
+        value = str(mapped_data.get(field, '')).strip()
+        logger.info(f"Checking field '{field}': '{value}'")
+        if not value:
+            logger.error(f"Missing or empty required field: {field}")
+            return jsonify({"error": f"{field} is required"}), 400
+
+    # Email validation
+    email = str(mapped_data.get('contact_email', '')).strip()
+    if not validate_email(email):
+        logger.error(f"Invalid email format: '{email}'")
+        return jsonify({"error": "Invalid email format"}), 400
+
+    # Log customer info
+    logger.info(
+        f"Customer: {mapped_data.get('contact_name')} - Equipment: {mapped_data.get('equipment_type')} {mapped_data.get('equipment_brand')}")
 
-            return jsonify({
-                "status": "success",
-                "message": "Equipment repair ticket created successfully",
-                "ticket_created": {
-                    "id": ticket_data.get('id'),
-                    "subject": ticket_data.get('subject'),
-                    "status": "created",
-                    "type": "equipment_repair"
-                },
-                "customer": {
-                    "name": mapped_data.get('contact_name'),
-                    "email": mapped_data.get('contact_email'),
-                    "business": mapped_data.get('business_name')
-                },
-                "timestamp": datetime.now().isoformat()
-            })
-        else:
-            error_msg = ticket_result.get('error', 'Unknown error') if ticket_result else 'Ticket creation failed'
-            logger.error(f"❌ Ticket creation failed: {error_msg}")
-            return jsonify({
-                "error": "Failed to create repair ticket",
-                "details": error_msg,
-                "timestamp": datetime.now().isoformat()
-            }), 500
+    # Create ticket using mapped data
+    logger.info("Creating Freshdesk ticket...")
+    ticket_result = create_repair_ticket_direct(mapped_data)
+
+    if ticket_result and ticket_result.get('success'):
+        ticket_data = ticket_result.get('ticket_data', {})
+        logger.info(f"✅ Successfully created ticket: {ticket_data.get('id')}")
 
-    except json.JSONDecodeError:
-        logger.error("JSON parsing error")
-        return jsonify({"error": "Invalid JSON format"}), 400
-    except Exception as e:
-        logger.error(f"WordPress webhook error: {str(e)}")
         return jsonify({
-            "error": "Internal server error",
-            "message": str(e) if os.getenv('FLASK_DEBUG') == 'True' else "Please contact administrator",
-            "timestamp": datetime.now().isoformat()
+            "status": "success",
+            "message": "Equipment repair ticket created successfully",
+            "ticket_created": {
+                "id": ticket_data.get('id'),
+                "subject": ticket_data.get('subject'),
+                "status": "created",
+                "type": "equipment_repair"
+            },
+            "customer": {
+                "name": mapped_data.get('contact_name'),
+                "email": mapped_data.get('contact_email'),
+                "business": mapped_data.get('business_name')
+            },
+            "timestamp": iso_now()
+        })
+    else:
+        error_msg = ticket_result.get('error', 'Unknown error') if ticket_result else 'Ticket creation failed'
+        logger.error(f"❌ Ticket creation failed: {error_msg}")
+        return jsonify({
+            "error": "Failed to create repair ticket",
+            "details": error_msg,
+            "timestamp": iso_now()
         }), 500
 
 
+# WordPress field -> internal field. Password keys are applied separately, in
+# _PASSWORD_KEYS_ORDERED order, so the later key wins when both are present
+_WP_FIELD_MAP = {
+    'email': 'contact_email',
+    'name': 'contact_name',
+    'phone': 'contact_phone',
+    'company': 'business_name',
+    'subject': 'subject',
+    'message': 'full_message',
+    'priority': 'priority',
+    'ticket_type': 'ticket_type',
+    'tags': 'tags'
+}
+_PASSWORD_KEYS_ORDERED = ('user_profile_password', 'password')
+
+# WordPress custom field -> internal field
+_CF_FIELD_MAP = {
+    'equipment_brand': 'equipment_brand',
+    'equipment_model': 'equipment_model',
+    'serial_number': 'serial_number',
+    'store_location': 'store_location',
+    'repair_date': 'repair_date',
+    'repair_time': 'repair_time',
+    'internal_ticket_id': 'internal_ticket_id',
+    'user_profile_password': 'user_profile_password'
+}
+
+
 def map_wordpress_fields(form_data):
     """Map WordPress field names to expected internal field names - FIXED PASSWORD PRIORITY"""
     try:
-        # Extract fields from the structured message if available
+        # Parse the message once - structured fields, fault description and password all come from this pass
         message = form_data.get('message', '')
+        parsed_message = parse_message(message)
         mapped_data = {}
 
         # First, try to extract from the structured message
         if '=== EQUIPMENT REPAIR REQUEST ===' in message:
-            mapped_data = extract_from_structured_message(message)
+            mapped_data = dict(parsed_message['fields'])
             logger.info("📝 Extracted data from structured message")
 
         # Then map the direct WordPress fields, giving priority to top-level fields
-        field_mapping = {
-            # WordPress field -> Internal field
-            'email': 'contact_email',
-            'name': 'contact_name',
-            'phone': 'contact_phone',
-            'company': 'business_name',
-            'subject': 'subject',
-            'message': 'full_message',
-            'priority': 'priority',
-            'ticket_type': 'ticket_type',
-            'tags': 'tags',
-            # Direct password field mappings
-            'user_profile_password': 'user_profile_password',
-            'password': 'user_profile_password'
-        }
-
-        # Map direct fields
-        for wp_field, internal_field in field_mapping.items():
-            if wp_field in form_data and form_data[wp_field]:
-                mapped_data[internal_field] = form_data[wp_field]
+        mapped_data.update((_WP_FIELD_MAP[k], v) for k, v in form_data.items() if k in _WP_FIELD_MAP and v)
+        mapped_data.update(
+            ('user_profile_password', form_data[k]) for k in _PASSWORD_KEYS_ORDERED if form_data.get(k)
+        )
 
         # Map custom fields if they exist
         custom_fields = form_data.get('custom_fields', {})
         if custom_fields:
-            custom_field_mapping = {
-                'equipment_brand': 'equipment_brand',
-                'equipment_model': 'equipment_model',
-                'serial_number': 'serial_number',
-                'store_location': 'store_location',
-                'repair_date': 'repair_date',
-                'repair_time': 'repair_time',
-                'internal_ticket_id': 'internal_ticket_id',
-                'user_profile_password': 'user_profile_password'
-            }
-
-            for cf_field, internal_field in custom_field_mapping.items():
-                if cf_field in custom_fields and custom_fields[cf_field]:
-                    mapped_data[internal_field] = custom_fields[cf_field]
+            mapped_data.update((_CF_FIELD_MAP[k], v) for k, v in custom_fields.items() if k in _CF_FIELD_MAP and v)
 
         # Enhanced password detection with priority order
         password_sources = [
@@ -348,7 +495,7 @@ def map_wordpress_fields(form_data):
         for field_name, source_data in password_sources:
             if field_name in source_data and source_data[field_name]:
                 password_value = str(source_data[field_name]).strip()
-                if password_value and password_value.lower() not in ['yes', 'no', 'provided', 'not provided']:
+                if password_value and password_value.lower() not in _PASSWORD_STATUS_WORDS:
                     mapped_data['user_profile_password'] = password_value
                     logger.info(f"🔑 Found password in {field_name}: {password_value}")
                     password_found = True
@@ -356,7 +503,7 @@ def map_wordpress_fields(form_data):
 
         # Only as a last resort, try to find password in message
         if not password_found and 'full_message' in mapped_data:
-            password_value = find_password_in_message(mapped_data['full_message'])
+            password_value = parsed_message['password']
             if password_value:
                 mapped_data['user_profile_password'] = password_value
                 logger.info("🔑 Extracted password from message as fallback")
@@ -379,7 +526,7 @@ def map_wordpress_fields(form_data):
 
         # Extract fault description from full message if not already set
         if 'fault_description' not in mapped_data and 'full_message' in mapped_data:
-            fault_desc = extract_fault_description_from_message(mapped_data['full_message'])
+            fault_desc = parsed_message['fields'].get('fault_description')
             if fault_desc:
                 mapped_data['fault_description'] = fault_desc
 
@@ -394,149 +541,112 @@ def map_wordpress_fields(form_data):
         return form_data  # Return original data if mapping fails
 
 
-def extract_from_structured_message(message):
-    """Extract structured data from the formatted message - FIXED PASSWORD EXTRACTION"""
+# Structured message parsing - one multiline regex classifies every line as a
+# section header ("FAULT DESCRIPTION:"), a "Key: value" pair or a free-text line
+_MESSAGE_LINE_RE = re.compile(
+    r'^[ \t]*(?:'
+    r'(?P<header>[A-Z][^a-z:\r\n]*):'
+    r'|(?P<key>[^:\r\n]*?)[ \t]*:[ \t]*(?P<value>[^\r\n]*?)'
+    r'|(?P<text>[^\s:][^:\r\n]*?)'
+    r')[ \t\r]*$',
+    re.MULTILINE
+)
+
+# Lowercases ASCII letters and turns spaces into underscores in one translate() pass
+_KEY_TRANS = str.maketrans({' ': '_', **{c: c.lower() for c in string.ascii_uppercase}})
+
+# Message label (lowercased, spaces -> underscores) -> internal field
+_MESSAGE_FIELD_MAP = {
+    'contact_name': 'contact_name',
+    'business_name': 'business_name',
+    'phone': 'contact_phone',
+    'email': 'contact_email',
+    'equipment_type': 'equipment_type',
+    'brand': 'equipment_brand',
+    'model': 'equipment_model',
+    'serial_number': 'serial_number',
+    'store_location': 'store_location',
+    'preferred_date': 'repair_date',
+    'preferred_time': 'repair_time',
+    'ticket_id': 'internal_ticket_id',
+    'internal_ticket_id': 'internal_ticket_id',
+    'profile_name': 'user_profile_name',
+    # Direct password mapping
+    'password': 'user_profile_password',
+    'user_profile_password': 'user_profile_password'
+}
+
+# Free-text sections -> (internal field, separator used to join their lines)
+_MESSAGE_TEXT_SECTIONS = {
+    'fault_description': ('fault_description', ' '),
+    'additional_comments': ('additional_comments', ' '),
+    'accessories_included': ('accessories', ', ')
+}
+
+
+def parse_message(message):
+    """Parse a form message in a single pass.
+
+    Returns {'fields': {...}, 'password': str or None} where 'fields' holds the structured
+    key/value data plus the fault description, additional comments and accessories text,
+    and 'password' is the first real password value found anywhere in the message.
+    """
     extracted_data = {}
+    password = None
 
     try:
-        lines = message.split('\n')
         current_section = None
 
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
+        for match in _MESSAGE_LINE_RE.finditer(message):
+            header, key, text = match.group('header', 'key', 'text')
 
             # Check for section headers
-            if line.endswith(':') and line.isupper():
-                current_section = line[:-1].lower().replace(' ', '_')
+            if header is not None:
+                current_section = header.translate(_KEY_TRANS)
                 continue
 
-            # Extract key-value pairs
-            if ':' in line and current_section:
-                key, value = line.split(':', 1)
-                key = key.strip().lower().replace(' ', '_')
-                value = value.strip()
-
-                # Map common fields
-                field_mappings = {
-                    'contact_name': 'contact_name',
-                    'business_name': 'business_name',
-                    'phone': 'contact_phone',
-                    'email': 'contact_email',
-                    'equipment_type': 'equipment_type',
-                    'brand': 'equipment_brand',
-                    'model': 'equipment_model',
-                    'serial_number': 'serial_number',
-                    'store_location': 'store_location',
-                    'preferred_date': 'repair_date',
-                    'preferred_time': 'repair_time',
-                    'ticket_id': 'internal_ticket_id',
-                    'internal_ticket_id': 'internal_ticket_id',
-                    'profile_name': 'user_profile_name',
-                    # Direct password mapping
-                    'password': 'user_profile_password',
-                    'user_profile_password': 'user_profile_password'
-                }
+            if key is not None:
+                key = key.translate(_KEY_TRANS)
+                value = match.group('value')
 
-                if key in field_mappings and value and value != 'Not provided':
-                    extracted_data[field_mappings[key]] = value
+                # Password lines are accepted anywhere, but only actual values - not status indicators
+                if (password is None and key.endswith('password') and len(value) > 2 and
+                        value.lower() not in _PASSWORD_STATUS_WORDS):
+                    password = value
 
-                # Skip the problematic password_provided logic - we'll handle passwords differently
-                # The actual password should come from direct WordPress fields, not from status
+                if key not in _MESSAGE_TEXT_SECTIONS:
+                    field = _MESSAGE_FIELD_MAP.get(key)
+                    if current_section and field and value and value != 'Not provided':
+                        extracted_data[field] = value
+                    continue
 
-            # Extract fault description (special handling)
-            elif current_section == 'fault_description' and line and not line.endswith(':'):
-                if 'fault_description' not in extracted_data:
-                    extracted_data['fault_description'] = line
-                else:
-                    extracted_data['fault_description'] += ' ' + line
+                # Inline free-text header, e.g. "FAULT DESCRIPTION: Screen is cracked"
+                current_section, text = key, value
+                if not text:
+                    continue
 
-            # Extract additional comments (special handling)
-            elif current_section == 'additional_comments' and line and not line.endswith(':'):
-                if 'additional_comments' not in extracted_data:
-                    extracted_data['additional_comments'] = line
-                else:
-                    extracted_data['additional_comments'] += ' ' + line
+            # "=== END OF REPAIR REQUEST ===" closes the current section
+            elif '===' in text:
+                current_section = None
+                continue
 
-            # Extract accessories (special handling)
-            elif current_section == 'accessories_included' and line and not line.endswith(':'):
-                if 'accessories' not in extracted_data:
-                    extracted_data['accessories'] = line
+            # Free-text lines belong to fault description / comments / accessories
+            if current_section in _MESSAGE_TEXT_SECTIONS:
+                field, separator = _MESSAGE_TEXT_SECTIONS[current_section]
+                if field in extracted_data:
+                    extracted_data[field] += separator + text
                 else:
-                    extracted_data['accessories'] += ', ' + line
+                    extracted_data[field] = text
 
-        logger.info(f"📤 Extracted {len(extracted_data)} fields from structured message")
-        return extracted_data
+        logger.info(f"📤 Extracted {len(extracted_data)} fields from message"
+                    f"{', password found' if password else ''}")
 
     except Exception as e:
-        logger.error(f"Message extraction error: {str(e)}")
-        return {}
+        logger.error(f"Message parsing error: {str(e)}")
+        extracted_data = {}
+        password = None
 
-
-def find_password_in_message(message):
-    """Enhanced password finder - looks for actual password values"""
-    try:
-        lines = message.split('\n')
-        for line in lines:
-            line = line.strip()
-
-            # Look for lines that have actual password values
-            password_patterns = [
-                'password:',
-                'user profile password:',
-                'profile password:',
-                'account password:',
-                'user password:'
-            ]
-
-            for pattern in password_patterns:
-                if pattern in line.lower() and ':' in line:
-                    password_part = line.split(':', 1)[1].strip()
-                    # Make sure it's not just a status indicator
-                    if (password_part and
-                            password_part.lower() not in ['yes', 'no', 'provided', 'not provided', 'true', 'false'] and
-                            len(password_part) > 2):  # Reasonable password length
-                        logger.info(f"🔑 Found password in message: {pattern}")
-                        return password_part
-
-        return None
-    except Exception as e:
-        logger.error(f"Password extraction error: {str(e)}")
-        return None
-
-
-def extract_fault_description_from_message(message):
-    """Extract fault description from message text"""
-    try:
-        if 'FAULT DESCRIPTION:' in message:
-            lines = message.split('\n')
-            capture = False
-            fault_lines = []
-
-            for line in lines:
-                line = line.strip()
-                if 'FAULT DESCRIPTION:' in line:
-                    capture = True
-                    # Get description on same line if exists
-                    if ':' in line:
-                        desc_part = line.split(':', 1)[1].strip()
-                        if desc_part:
-                            fault_lines.append(desc_part)
-                    continue
-                elif capture and line and not line.isupper() and ':' not in line:
-                    fault_lines.append(line)
-                elif capture and (line.isupper() or '===' in line):
-                    break
-
-            if fault_lines:
-                return ' '.join(fault_lines)
-
-        return None
-
-    except Exception as e:
-        logger.error(f"Fault description extraction error: {str(e)}")
-        return None
+    return {'fields': extracted_data, 'password': password}
 
 
 def create_repair_ticket_direct(form_data):
@@ -587,8 +697,9 @@ def create_repair_ticket_direct(form_data):
         if phone:
             contact_data["phone"] = phone
 
-        logger.info(f"👤 Attempting to create/update contact: {json.dumps(contact_data, indent=2)}")
-        contact_result = create_or_update_contact(contact_data)
+        logger.debug("👤 Attempting to create/update contact: %s", LazyJson(contact_data))
+        # 联系人同步与第一次创建票据并行进行，只有需要 requester_id 重试时才等待其结果
+        contact_future = FRESHDESK_EXECUTOR.submit(create_or_update_contact, contact_data)
 
         # 构建票据数据 - 使用正确的字段名
         ticket_data_v1 = {
@@ -621,12 +732,13 @@ def create_repair_ticket_direct(form_data):
             return {'success': False, 'error': 'Final email validation failed'}
 
         # 记录票据数据用于调试
-        logger.info(f"📦 Prepared ticket data (v1): {json.dumps(ticket_data_v1, ensure_ascii=False, indent=2)}")
+        logger.debug("📦 Prepared ticket data (v1): %s", LazyJson(ticket_data_v1))
 
         # 尝试创建票据
         result = create_freshdesk_ticket(ticket_data_v1)
 
         # 如果第一种方式失败，尝试第二种方式（如果有联系人ID）
+        contact_result = contact_future.result() if not result.get('success') else None
         if not result.get('success') and contact_result:
             logger.info("🔄 First attempt failed, trying with requester_id...")
             ticket_data_v2 = ticket_data_v1.copy()
@@ -637,7 +749,7 @@ def create_repair_ticket_direct(form_data):
                 ticket_data_v2.pop('name', None)
                 ticket_data_v2.pop('phone', None)
 
-                logger.info(f"📦 Prepared ticket data (v2): {json.dumps(ticket_data_v2, ensure_ascii=False, indent=2)}")
+                logger.debug("📦 Prepared ticket data (v2): %s", LazyJson(ticket_data_v2))
                 result = create_freshdesk_ticket(ticket_data_v2)
 
         return result
@@ -653,155 +765,150 @@ def create_repair_ticket_direct(form_data):
         }
 
 
+def _field_value(form_data, key, default="Not provided"):
+    """Stripped string value of a form field, or the default when missing/empty"""
+    value = form_data.get(key)
+    if value is None:
+        return default
+    value = str(value).strip()
+    return value if value else default
+
+
 def format_ticket_description_clean(form_data):
     """简洁的票据描述格式 - 显示实际密码值"""
-
-    def get_value(key, default="Not provided"):
-        value = form_data.get(key)
-        if value is None:
-            return default
-        value = str(value).strip()
-        return value if value else default
-
-    # 基本信息
-    description = "=== EQUIPMENT REPAIR REQUEST ===\n\n"
-
-    # 客户信息
-    description += "CUSTOMER DETAILS:\n"
-    description += f"Contact Name: {get_value('contact_name')}\n"
-    description += f"Business Name: {get_value('business_name')}\n"
-    description += f"Phone: {get_value('contact_phone')}\n"
-    description += f"Email: {get_value('contact_email')}\n\n"
-
-    # 设备信息
-    description += "EQUIPMENT INFORMATION:\n"
-    description += f"Equipment Type: {get_value('equipment_type', 'Not specified')}\n"
-    description += f"Brand: {get_value('equipment_brand', 'Not specified')}\n"
-    description += f"Model: {get_value('equipment_model', 'Not specified')}\n"
-    description += f"Serial Number: {get_value('serial_number')}\n\n"
-
-    # 服务详情
-    description += "SERVICE DETAILS:\n"
-    description += f"Store Location: {get_value('store_location', 'Not specified')}\n"
-    description += f"Preferred Date: {get_value('repair_date', 'Not specified')}\n"
-    description += f"Preferred Time: {get_value('repair_time', 'Not specified')}\n\n"
-
-    # 故障描述
-    description += f"FAULT DESCRIPTION:\n{get_value('fault_description', 'No description provided')}\n\n"
+    lines = [
+        # 基本信息
+        "=== EQUIPMENT REPAIR REQUEST ===",
+        "",
+
+        # 客户信息
+        "CUSTOMER DETAILS:",
+        f"Contact Name: {_field_value(form_data, 'contact_name')}",
+        f"Business Name: {_field_value(form_data, 'business_name')}",
+        f"Phone: {_field_value(form_data, 'contact_phone')}",
+        f"Email: {_field_value(form_data, 'contact_email')}",
+        "",
+
+        # 设备信息
+        "EQUIPMENT INFORMATION:",
+        f"Equipment Type: {_field_value(form_data, 'equipment_type', 'Not specified')}",
+        f"Brand: {_field_value(form_data, 'equipment_brand', 'Not specified')}",
+        f"Model: {_field_value(form_data, 'equipment_model', 'Not specified')}",
+        f"Serial Number: {_field_value(form_data, 'serial_number')}",
+        "",
+
+        # 服务详情
+        "SERVICE DETAILS:",
+        f"Store Location: {_field_value(form_data, 'store_location', 'Not specified')}",
+        f"Preferred Date: {_field_value(form_data, 'repair_date', 'Not specified')}",
+        f"Preferred Time: {_field_value(form_data, 'repair_time', 'Not specified')}",
+        "",
+
+        # 故障描述
+        "FAULT DESCRIPTION:",
+        _field_value(form_data, 'fault_description', 'No description provided'),
+        ""
+    ]
 
     # 配件
-    accessories = get_value('accessories', 'None specified')
+    accessories = _field_value(form_data, 'accessories', 'None specified')
     if accessories != 'None specified':
-        description += f"ACCESSORIES INCLUDED:\n{accessories}\n\n"
+        lines += ["ACCESSORIES INCLUDED:", accessories, ""]
 
     # 额外备注
-    comments = get_value('additional_comments', '')
+    comments = _field_value(form_data, 'additional_comments', '')
     if comments:
-        description += f"ADDITIONAL COMMENTS:\n{comments}\n\n"
+        lines += ["ADDITIONAL COMMENTS:", comments, ""]
 
     # 用户账户信息 - 显示实际密码值
-    profile_name = get_value('user_profile_name', '')
-    password = get_value('user_profile_password', '')
+    profile_name = _field_value(form_data, 'user_profile_name', '')
+    password = _field_value(form_data, 'user_profile_password', '')
 
     if profile_name or password:
-        description += "USER ACCOUNT:\n"
+        lines.append("USER ACCOUNT:")
         if profile_name:
-            description += f"Profile Name: {profile_name}\n"
+            lines.append(f"Profile Name: {profile_name}")
         if password:
             # 显示实际密码值（根据用户需求）
-            description += f"Password: {password}\n"
-        description += "\n"
+            lines.append(f"Password: {password}")
+        lines.append("")
 
     # 内部参考
-    internal_id = get_value('internal_ticket_id', '')
+    internal_id = _field_value(form_data, 'internal_ticket_id', '')
     if internal_id:
-        description += f"INTERNAL REFERENCE:\nInternal Ticket ID: {internal_id}\n\n"
+        lines += ["INTERNAL REFERENCE:", f"Internal Ticket ID: {internal_id}", ""]
 
-    description += "=== END OF REPAIR REQUEST ==="
+    lines.append("=== END OF REPAIR REQUEST ===")
 
-    return description
+    return "\n".join(lines)
 
 
 # ===================
 # Freshdesk Integration
 # ===================
 
-@app.route('/webhook/freshdesk', methods=['POST', 'GET'])
-def freshdesk_webhook():
-    """Handle webhook from Freshdesk"""
-    try:
-        # Handle GET request (endpoint verification)
-        if request.method == 'GET':
-            logger.info("Received Freshdesk webhook GET request - endpoint verification")
-            return jsonify({
-                "status": "ok",
-                "message": "1Cyber Freshdesk webhook endpoint is active",
-                "timestamp": datetime.now().isoformat(),
-                "endpoint": "/webhook/freshdesk"
-            })
+_FRESHDESK_VERIFY_PREFIX, _FRESHDESK_VERIFY_SUFFIX = prebuild_timestamped_json({
+    "status": "ok",
+    "message": "1Cyber Freshdesk webhook endpoint is active",
+    "endpoint": "/webhook/freshdesk"
+})
 
-        # Handle POST request
-        logger.info("Received Freshdesk webhook POST request")
 
-        payload = request.get_data()
-        signature = request.headers.get('X-Freshdesk-Signature', '')
+@app.route('/webhook/freshdesk', methods=['GET'])
+def freshdesk_webhook_verify():
+    """Freshdesk webhook endpoint verification"""
+    logger.info("Received Freshdesk webhook GET request - endpoint verification")
+    return timestamped_json_response(_FRESHDESK_VERIFY_PREFIX, _FRESHDESK_VERIFY_SUFFIX)
 
-        # Log received webhook
-        logger.info(f"Freshdesk webhook signature: {signature[:20] if signature else 'None'}...")
 
-        # Verify signature (if WEBHOOK_SECRET configured)
-        if WEBHOOK_SECRET and signature:
-            if not verify_webhook_signature(payload, signature):
-                logger.warning("Freshdesk webhook signature verification failed")
-                return jsonify({"error": "Invalid signature"}), 403
+@app.route('/webhook/freshdesk', methods=['POST'])
+def freshdesk_webhook():
+    """Handle webhook from Freshdesk"""
+    logger.info("Received Freshdesk webhook POST request")
 
-        webhook_data = request.get_json()
+    # The raw body is read once: it is both the signed payload and the JSON to parse
+    payload = request.get_data(cache=True)
+    signature = request.headers.get('X-Freshdesk-Signature', '')
 
-        if not webhook_data:
-            logger.error("No Freshdesk webhook data received")
-            return jsonify({"error": "No JSON data received"}), 400
+    # Log received webhook
+    logger.debug("Freshdesk webhook signature: %s...", signature[:20] if signature else 'None')
 
-        event_type = webhook_data.get('event_type', 'unknown')
-        ticket_data = webhook_data.get('ticket', {})
+    # Verify signature (if WEBHOOK_SECRET configured)
+    if WEBHOOK_SECRET and signature:
+        if not verify_webhook_signature(payload, signature):
+            logger.warning("Freshdesk webhook signature verification failed")
+            return jsonify({"error": "Invalid signature"}), 403
 
-        logger.info(f"Received Freshdesk webhook: {event_type} - Ticket ID: {ticket_data.get('id', 'unknown')}")
+    try:
+        webhook_data = orjson.loads(payload) if payload else None
+    except orjson.JSONDecodeError:
+        logger.error("Freshdesk webhook JSON parsing error")
+        return jsonify({"error": "Invalid JSON format"}), 400
 
-        # Process different event types
-        result = {"processed": False, "action": "none"}
+    if not webhook_data:
+        logger.error("No Freshdesk webhook data received")
+        return jsonify({"error": "No JSON data received"}), 400
 
-        if event_type == 'ticket_created':
-            result = handle_ticket_created(ticket_data)
-        elif event_type == 'ticket_updated':
-            result = handle_ticket_updated(ticket_data)
-        elif event_type == 'ticket_resolved':
-            result = handle_ticket_resolved(ticket_data)
-            # Create invoice for resolved tickets if needed
-            if should_create_invoice(ticket_data):
-                invoice_result = create_invoice_for_resolved_ticket(ticket_data)
-                result["invoice_created"] = invoice_result
-        else:
-            logger.info(f"Unhandled event type: {event_type}")
-            result = {"processed": True, "action": "ignored", "reason": "unsupported_event_type"}
+    event_type = webhook_data.get('event_type', 'unknown')
+    ticket_data = webhook_data.get('ticket', {})
 
-        return jsonify({
-            "status": "success",
-            "message": "Webhook processed successfully",
-            "event_type": event_type,
-            "ticket_id": ticket_data.get('id'),
-            "result": result,
-            "timestamp": datetime.now().isoformat()
-        }), 200
-
-    except json.JSONDecodeError:
-        logger.error("Freshdesk webhook JSON parsing error")
-        return jsonify({"error": "Invalid JSON format"}), 400
-    except Exception as e:
-        logger.error(f"Freshdesk webhook processing error: {str(e)}")
-        return jsonify({
-            "error": "Internal server error",
-            "message": str(e) if os.getenv('FLASK_DEBUG') == 'True' else "Please contact administrator",
-            "timestamp": datetime.now().isoformat()
-        }), 500
+    logger.info("Received Freshdesk webhook: %s - Ticket ID: %s", event_type, ticket_data.get('id', 'unknown'))
+
+    # Hand the event to the background workers and acknowledge straight away
+    _ensure_background_workers()
+    try:
+        _webhook_queue.put_nowait((event_type, ticket_data))
+    except queue.Full:
+        logger.error("Freshdesk webhook queue is full - asking Freshdesk to retry")
+        return jsonify({"error": "Webhook queue is full, please retry later"}), 503
+
+    return jsonify({
+        "status": "accepted",
+        "message": "Webhook queued for processing",
+        "event_type": event_type,
+        "ticket_id": ticket_data.get('id'),
+        "timestamp": iso_now()
+    }), 202
 
 
 def handle_ticket_created(ticket_data):
@@ -831,7 +938,66 @@ def handle_ticket_resolved(ticket_data):
     ticket_id = ticket_data.get('id')
     logger.info(f"Ticket {ticket_id} resolved")
 
-    return {"processed": True, "action": "resolved_processed", "ticket_id": ticket_id}
+    result = {"processed": True, "action": "resolved_processed", "ticket_id": ticket_id}
+    # Create invoice for resolved tickets if needed
+    invoice_data = maybe_extract_invoice(ticket_data)
+    if invoice_data:
+        result["invoice_created"] = create_invoice_for_resolved_ticket(ticket_id, invoice_data)
+    return result
+
+
+# Freshdesk webhook event_type -> handler
+_EVENT_HANDLERS = {
+    'ticket_created': handle_ticket_created,
+    'ticket_updated': handle_ticket_updated,
+    'ticket_resolved': handle_ticket_resolved
+}
+
+
+def process_freshdesk_event(event_type, ticket_data):
+    """Run the handler for one Freshdesk webhook event"""
+    handler = _EVENT_HANDLERS.get(event_type)
+    if handler:
+        result = handler(ticket_data)
+    else:
+        logger.info(f"Unhandled event type: {event_type}")
+        result = {"processed": True, "action": "ignored", "reason": "unsupported_event_type"}
+
+    logger.info("Processed Freshdesk webhook: %s - %s", event_type, result)
+    return result
+
+
+# Freshdesk webhook events are processed off the request thread. Background threads are
+# started lazily per process, so a preloaded Gunicorn master never owns them.
+_webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+_background_workers_pid = None
+_background_workers_lock = threading.Lock()
+
+
+def _webhook_worker():
+    """Drain the webhook queue forever"""
+    while True:
+        event_type, ticket_data = _webhook_queue.get()
+        try:
+            process_freshdesk_event(event_type, ticket_data)
+        except Exception as e:
+            logger.error(f"Freshdesk webhook processing error ({event_type}): {str(e)}")
+        finally:
+            _webhook_queue.task_done()
+
+
+def _ensure_background_workers():
+    """Start the webhook worker threads and the Xero invoice flusher once in the current process"""
+    global _background_workers_pid
+    if _background_workers_pid == os.getpid():
+        return
+    with _background_workers_lock:
+        if _background_workers_pid == os.getpid():
+            return
+        for i in range(WEBHOOK_WORKERS):
+            threading.Thread(target=_webhook_worker, name=f"webhook-{i}", daemon=True).start()
+        threading.Thread(target=_invoice_flusher, name="xero-invoice-flusher", daemon=True).start()
+        _background_workers_pid = os.getpid()
 
 
 def create_freshdesk_ticket(ticket_data):
@@ -844,20 +1010,15 @@ def create_freshdesk_ticket(ticket_data):
                 "error": "Freshdesk configuration incomplete"
             }
 
-        url = f"https://{FRESHDESK_DOMAIN}/api/v2/tickets"
-        headers = {
-            "Authorization": f"Basic {freshdesk_auth}",
-            "Content-Type": "application/json"
-        }
+        url = _FD_TICKETS_URL
 
         # 详细记录发送给Freshdesk的数据
-        logger.info(f"🚀 Sending request to Freshdesk: {url}")
-        logger.info(f"📧 Freshdesk API Headers: {headers}")
-        logger.info(f"📦 Freshdesk API Payload: {json.dumps(ticket_data, ensure_ascii=False, indent=2)}")
+        logger.info("🚀 Sending request to Freshdesk: %s", url)
+        logger.debug("📦 Freshdesk API Payload: %s", LazyJson(ticket_data))
 
         # 特别检查email字段
         email_value = ticket_data.get('email')
-        logger.info(f"🔍 Email field check: email='{email_value}' (type: {type(email_value)})")
+        logger.debug("🔍 Email field check: email='%s' (type: %s)", email_value, type(email_value))
 
         if not email_value:
             logger.error("❌ Email field is empty or None before sending to Freshdesk!")
@@ -866,34 +1027,36 @@ def create_freshdesk_ticket(ticket_data):
                 "error": "Email field is empty before sending to Freshdesk"
             }
 
-        response = requests.post(url, headers=headers, json=ticket_data, timeout=30)
+        response = SESSION.post(url, json=ticket_data, timeout=30)
 
-        logger.info(f"📥 Freshdesk API response status: {response.status_code}")
-        logger.info(f"📥 Freshdesk API response headers: {dict(response.headers)}")
-        logger.info(f"📥 Freshdesk API response content: {response.text}")
+        status = response.status_code
+        body = response.content
+        logger.info("📥 Freshdesk API response status: %s", status)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📥 Freshdesk API response headers: %s", response.headers)
+            logger.debug("📥 Freshdesk API response content: %s", body)
 
-        if response.status_code == 201:
-            ticket = response.json()
+        if status == HTTPStatus.CREATED:
+            ticket = orjson.loads(body)
             logger.info(f"✅ Successfully created ticket: {ticket.get('id')}")
             return {
                 "success": True,
                 "ticket_data": ticket
             }
-        else:
-            error_msg = f"HTTP {response.status_code}: {response.text}"
-            logger.error(f"❌ Ticket creation failed: {error_msg}")
 
-            # 尝试解析Freshdesk错误响应
-            try:
-                error_detail = response.json()
-                logger.error(f"❌ Freshdesk error details: {json.dumps(error_detail, indent=2)}")
-            except:
-                logger.error(f"❌ Could not parse Freshdesk error response")
+        error_msg = f"HTTP {status}: {body.decode('utf-8', 'replace')}"
+        logger.error(f"❌ Ticket creation failed: {error_msg}")
 
-            return {
-                "success": False,
-                "error": error_msg
-            }
+        # 尝试解析Freshdesk错误响应
+        try:
+            logger.error("❌ Freshdesk error details: %s", LazyJson(orjson.loads(body)))
+        except orjson.JSONDecodeError:
+            logger.error("❌ Could not parse Freshdesk error response")
+
+        return {
+            "success": False,
+            "error": error_msg
+        }
 
     except requests.exceptions.Timeout:
         error_msg = "Request timeout"
@@ -909,6 +1072,11 @@ def create_freshdesk_ticket(ticket_data):
         return {"success": False, "error": error_msg}
 
 
+# Freshdesk contact IDs are stable, so email -> contact id lookups are cached to skip the search call
+_contact_id_cache = TTLCache(maxsize=CONTACT_CACHE_SIZE, ttl=CONTACT_CACHE_TTL)
+_contact_id_cache_lock = threading.Lock()
+
+
 def create_or_update_contact(contact_data):
     """Create or update Freshdesk contact"""
     try:
@@ -916,30 +1084,44 @@ def create_or_update_contact(contact_data):
         if not email:
             return None
 
-        # Search for existing contact
-        url = f"https://{FRESHDESK_DOMAIN}/api/v2/contacts"
-        headers = {
-            "Authorization": f"Basic {freshdesk_auth}",
-            "Content-Type": "application/json"
-        }
+        url = _FD_CONTACTS_URL
+        with _contact_id_cache_lock:
+            contact_id = _contact_id_cache.get(email)
 
-        search_url = f"{url}?email={email}"
-        response = requests.get(search_url, headers=headers, timeout=30)
+        # Search for existing contact (cache miss only)
+        if contact_id is None:
+            response = SESSION.get(f"{url}?email={email}", timeout=30)
+            contacts = orjson.loads(response.content) if response.status_code == HTTPStatus.OK else None
+            if contacts:
+                contact_id = contacts[0]['id']
 
-        if response.status_code == 200 and response.json():
+        if contact_id is not None:
             # Update existing contact
-            contact_id = response.json()[0]['id']
-            update_url = f"{url}/{contact_id}"
-            response = requests.put(update_url, headers=headers, json=contact_data, timeout=30)
-            logger.info(f"Updated contact: {email}")
-        else:
+            response = SESSION.put(f"{url}/{contact_id}", json=contact_data, timeout=30)
+            if response.status_code == HTTPStatus.NOT_FOUND:
+                # Contact was deleted in Freshdesk since it was cached
+                with _contact_id_cache_lock:
+                    _contact_id_cache.pop(email, None)
+                contact_id = None
+            else:
+                logger.info(f"Updated contact: {email}")
+
+        if contact_id is None:
             # Create new contact
-            response = requests.post(url, headers=headers, json=contact_data, timeout=30)
+            response = SESSION.post(url, json=contact_data, timeout=30)
             logger.info(f"Created new contact: {email}")
 
-        return response.json() if response.status_code in [200, 201] else None
+        if response.status_code not in (HTTPStatus.OK, HTTPStatus.CREATED):
+            return None
 
-    except Exception as e:
+        contact = orjson.loads(response.content)
+        with _contact_id_cache_lock:
+            if contact.get('email', email) != email:
+                _contact_id_cache.pop(email, None)
+            _contact_id_cache[contact.get('email', email)] = contact['id']
+        return contact
+
+    except (RequestException, ValueError, KeyError) as e:
         logger.error(f"Contact creation/update error: {str(e)}")
         return None
 
@@ -948,23 +1130,15 @@ def create_or_update_contact(contact_data):
 # Xero Integration
 # ===================
 
-@app.route('/xero/auth')
-def xero_auth():
-    """Start Xero OAuth authentication flow"""
-    if not XERO_CLIENT_ID:
-        return jsonify({"error": "Xero client ID not configured"}), 400
+# Everything in the authorization URL except the per-request state is fixed at import
+_XERO_AUTH_BASE = "https://login.xero.com/identity/connect/authorize?" + urlencode({
+    "response_type": "code",
+    "client_id": XERO_CLIENT_ID,
+    "redirect_uri": XERO_REDIRECT_URI,
+    "scope": XERO_SCOPE
+})
 
-    auth_url = "https://login.xero.com/identity/connect/authorize"
-    params = {
-        "response_type": "code",
-        "client_id": XERO_CLIENT_ID,
-        "redirect_uri": XERO_REDIRECT_URI,
-        "scope": XERO_SCOPE,
-        "state": "random_state_string"
-    }
-
-    url = f"{auth_url}?{urlencode(params)}"
-    return f'''
+_XERO_AUTH_HTML = '''
     <html>
         <head><title>1Cyber - Xero Authorization</title></head>
         <body>
@@ -976,6 +1150,20 @@ def xero_auth():
     '''
 
 
+@app.route('/xero/auth')
+def xero_auth():
+    """Start Xero OAuth authentication flow"""
+    if not XERO_CLIENT_ID:
+        return jsonify({"error": "Xero client ID not configured"}), 400
+
+    # Random state, checked again in the callback to reject forged redirects (CSRF)
+    state = secrets.token_urlsafe(16)
+    session['xero_oauth_state'] = state
+
+    url = f"{_XERO_AUTH_BASE}&{urlencode({'state': state})}"
+    return _XERO_AUTH_HTML.format(url=url)
+
+
 @app.route('/xero/callback')
 def xero_callback():
     """Handle Xero OAuth callback"""
@@ -986,6 +1174,12 @@ def xero_callback():
         logger.error(f"Xero authorization error: {error}")
         return jsonify({"error": f"Authorization failed: {error}"}), 400
 
+    expected_state = session.pop('xero_oauth_state', None)
+    state = request.args.get('state')
+    if code and (not expected_state or not state or not hmac.compare_digest(state.encode(), expected_state.encode())):
+        logger.warning("Xero callback state mismatch")
+        return jsonify({"error": "Invalid OAuth state"}), 400
+
     if code:
         token_data = exchange_xero_token(code)
         if token_data:
@@ -1016,46 +1210,29 @@ def exchange_xero_token(auth_code):
             "Content-Type": "application/x-www-form-urlencoded"
         }
 
-        response = requests.post(token_url, data=data, headers=headers, timeout=30)
+        response = XERO_SESSION.post(token_url, data=data, headers=headers, timeout=30)
 
-        if response.status_code == 200:
-            return response.json()
+        if response.status_code == HTTPStatus.OK:
+            return orjson.loads(response.content)
         else:
             logger.error(f"Xero token exchange failed: {response.status_code} - {response.text}")
             return None
 
-    except Exception as e:
+    except (RequestException, ValueError) as e:
         logger.error(f"Xero token exchange error: {str(e)}")
         return None
 
 
-def should_create_invoice(ticket_data):
-    """Determine if invoice should be created for this ticket"""
-    tags = ticket_data.get('tags', [])
-    ticket_type = ticket_data.get('type', '')
-
-    return (
-            'billing' in [tag.lower() for tag in tags] or
-            'invoice' in [tag.lower() for tag in tags] or
-            ticket_type.lower() == 'billing'
-    )
+# Ticket tags (lowercased) that mark a resolved ticket as billable
+_BILLING_TAGS = frozenset({'billing', 'invoice'})
 
 
-def create_invoice_for_resolved_ticket(ticket_data):
-    """Create invoice for resolved ticket"""
-    try:
-        invoice_data = extract_billing_info_from_ticket(ticket_data)
-        if invoice_data:
-            result = create_xero_invoice_from_form(invoice_data)
-            logger.info(f"Created invoice for ticket {ticket_data.get('id')}")
-            return result
-    except Exception as e:
-        logger.error(f"Invoice creation error for ticket: {str(e)}")
+def maybe_extract_invoice(ticket_data):
+    """Billing information for a billable ticket (billing/invoice tag or billing type), otherwise None"""
+    tags = {tag.lower() for tag in ticket_data.get('tags', ())}
+    if not (tags & _BILLING_TAGS or ticket_data.get('type', '').lower() == 'billing'):
         return None
 
-
-def extract_billing_info_from_ticket(ticket_data):
-    """Extract billing information from ticket"""
     return {
         "name": "Customer Name",  # Extract from ticket
         "email": "customer@example.com",  # Extract from ticket
@@ -1064,6 +1241,19 @@ def extract_billing_info_from_ticket(ticket_data):
     }
 
 
+def create_invoice_for_resolved_ticket(ticket_id, invoice_data):
+    """Create invoice for resolved ticket"""
+    try:
+        result = create_xero_invoice_from_form(invoice_data)
+        if isinstance(result, Future):
+            logger.info(f"Queued invoice for ticket {ticket_id}")
+            return {"message": "Invoice queued for Xero"}
+        return result
+    except Exception as e:
+        logger.error(f"Invoice creation error for ticket: {str(e)}")
+        return None
+
+
 def create_xero_invoice_from_form(form_data):
     """Create Xero invoice from form data"""
     try:
@@ -1087,18 +1277,59 @@ def create_xero_invoice_from_form(form_data):
                     "AccountCode": "200"  # Replace with actual account code
                 }
             ],
-            "Reference": f"1CYBER-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            "Reference": f"1CYBER-{time.strftime('%Y%m%d%H%M%S')}"
         }
 
-        # This should call actual Xero API
-        logger.info(f"Prepared Xero invoice: {json.dumps(invoice_data, indent=2)}")
-        return {"message": "Invoice data prepared", "data": invoice_data}
+        # Queued for the batch flusher; the returned Future resolves once its batch is sent
+        _ensure_background_workers()
+        future = Future()
+        _invoice_queue.put((invoice_data, future))
+        return future
 
     except Exception as e:
         logger.error(f"Xero invoice creation error: {str(e)}")
         return None
 
 
+# Invoices are coalesced into one Xero "Invoices" payload per batch: a batch is sent
+# when INVOICE_BATCH_SIZE invoices are waiting or INVOICE_BATCH_MAX_WAIT seconds pass
+_invoice_queue = queue.Queue()
+
+
+def _invoice_flusher():
+    """Collect queued invoices into batches and flush them forever"""
+    while True:
+        batch = [_invoice_queue.get()]
+        deadline = time.monotonic() + INVOICE_BATCH_MAX_WAIT
+        while len(batch) < INVOICE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_invoice_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_invoice_batch(batch)
+
+
+def _flush_invoice_batch(batch):
+    """Send one batch of invoices to Xero and resolve each invoice's Future"""
+    try:
+        payload = {"Invoices": [invoice_data for invoice_data, _ in batch]}
+
+        # This should call actual Xero API (POST /Invoices accepts the whole batch)
+        logger.debug("Prepared Xero invoice batch: %s", LazyJson(payload))
+        logger.info(f"Prepared Xero invoice batch of {len(batch)}")
+
+        for invoice_data, future in batch:
+            future.set_result({"message": "Invoice data prepared", "data": invoice_data})
+    except Exception as e:
+        logger.error(f"Xero invoice batch error: {str(e)}")
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+
 # ===================
 # Notification Functions
 # ===================
@@ -1120,54 +1351,41 @@ def send_notification_email(subject, message):
 @app.route('/api/tickets', methods=['POST'])
 def create_ticket_api():
     """API endpoint: Create new ticket"""
-    try:
-        ticket_data = request.get_json()
-        if not ticket_data:
-            return jsonify({"error": "No ticket data provided"}), 400
+    ticket_data = request.get_json()
+    if not ticket_data:
+        return jsonify({"error": "No ticket data provided"}), 400
 
-        result = create_freshdesk_ticket(ticket_data)
-        if result and result.get('success'):
-            return jsonify(result.get('ticket_data')), 201
-        else:
-            return jsonify(
-                {"error": result.get('error', 'Ticket creation failed') if result else "Ticket creation failed"}), 500
-
-    except Exception as e:
-        logger.error(f"API ticket creation error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    result = create_freshdesk_ticket(ticket_data)
+    if result and result.get('success'):
+        return jsonify(result.get('ticket_data')), 201
+    else:
+        return jsonify(
+            {"error": result.get('error', 'Ticket creation failed') if result else "Ticket creation failed"}), 500
 
 
 @app.route('/api/tickets/<int:ticket_id>', methods=['GET'])
 def get_ticket(ticket_id):
     """Get specific ticket"""
-    try:
-        url = f"https://{FRESHDESK_DOMAIN}/api/v2/tickets/{ticket_id}"
-        headers = {
-            "Authorization": f"Basic {freshdesk_auth}",
-            "Content-Type": "application/json"
-        }
+    url = f"{_FD_TICKETS_URL}/{ticket_id}"
 
-        response = requests.get(url, headers=headers, timeout=30)
-
-        if response.status_code == 200:
-            return jsonify(response.json())
-        else:
-            return jsonify({
-                "error": "Failed to retrieve ticket",
-                "status_code": response.status_code
-            }), response.status_code
+    response = SESSION.get(url, timeout=30)
 
-    except Exception as e:
-        logger.error(f"Get ticket error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    if response.status_code == HTTPStatus.OK:
+        # Freshdesk already returns JSON - pass the body through without re-serialising it
+        return app.response_class(response.content, mimetype='application/json')
+    else:
+        return jsonify({
+            "error": "Failed to retrieve ticket",
+            "status_code": response.status_code
+        }), response.status_code
 
 
 @app.route('/test/connection', methods=['GET'])
 def test_all_connections():
     """Test all system connections"""
     results = {
-        "timestamp": datetime.now().isoformat(),
-        "environment": os.getenv('FLASK_ENV', 'production'),
+        "timestamp": iso_now(),
+        "environment": FLASK_ENV,
         "company": "1Cyber Computer Services",
         "version": "1.3.0",
         "features": [
@@ -1181,14 +1399,9 @@ def test_all_connections():
     # Test Freshdesk connection
     try:
         if FRESHDESK_DOMAIN and FRESHDESK_API_KEY:
-            url = f"https://{FRESHDESK_DOMAIN}/api/v2/tickets?per_page=1"
-            headers = {
-                "Authorization": f"Basic {freshdesk_auth}",
-                "Content-Type": "application/json"
-            }
-            response = requests.get(url, headers=headers, timeout=10)
+            response = SESSION.get(_FD_PING_URL, timeout=10)
             results['freshdesk'] = {
-                "status": "success" if response.status_code == 200 else "failed",
+                "status": "success" if response.status_code == HTTPStatus.OK else "failed",
                 "status_code": response.status_code,
                 "domain": FRESHDESK_DOMAIN
             }
@@ -1217,6 +1430,38 @@ def test_all_connections():
     return jsonify(results)
 
 
+@app.route('/health/all', methods=['GET'])
+def health_all():
+    """Run the main GET endpoints in-process and report each one's status code"""
+    views = {'/': home, '/health': health_check, '/test/connection': test_all_connections}
+
+    status_codes = {}
+    for path, view in views.items():
+        # Calling a view directly bypasses the registered error handlers, so map errors the same way
+        try:
+            status_codes[path] = app.make_response(view()).status_code
+        except HTTPException as e:
+            status_codes[path] = e.code
+        except RequestException as e:
+            logger.error(f"Health check of {path} failed: {str(e)}")
+            status_codes[path] = HTTPStatus.BAD_GATEWAY
+        except Exception as e:
+            logger.error(f"Health check of {path} failed: {str(e)}")
+            status_codes[path] = HTTPStatus.INTERNAL_SERVER_ERROR
+    # xero_auth writes the OAuth state into the session, so report it from configuration instead
+    if XERO_CLIENT_ID:
+        status_codes['/xero/auth'] = HTTPStatus.OK
+
+    endpoints = {}
+    for path, status_code in status_codes.items():
+        endpoints[path] = {
+            "status": "ok" if status_code in (HTTPStatus.OK, HTTPStatus.FOUND) else "error",
+            "status_code": status_code
+        }
+
+    return jsonify({"endpoints": endpoints, "timestamp": iso_now()})
+
+
 # ===================
 # Error Handlers
 # ===================
@@ -1232,30 +1477,69 @@ def internal_error(error):
     return jsonify({"error": "Internal server error"}), 500
 
 
+@app.errorhandler(RequestException)
+def handle_upstream_error(e):
+    logger.error(f"Upstream API error: {str(e)}")
+    return jsonify({
+        "error": "Upstream service unavailable",
+        "message": str(e) if DEBUG_MODE else "Please try again later",
+        "timestamp": iso_now()
+    }), 502
+
+
 @app.errorhandler(Exception)
 def handle_exception(e):
-    logger.error(f"Unhandled exception: {str(e)}")
-    return jsonify({"error": "Server error"}), 500
+    # Werkzeug HTTP errors (bad JSON -> 400, 405, ...) keep their status code
+    if isinstance(e, HTTPException):
+        return jsonify({"error": e.description}), e.code
+    logger.exception(f"Unhandled exception: {str(e)}")
+    return jsonify({
+        "error": "Internal server error",
+        "message": str(e) if DEBUG_MODE else "Please contact administrator",
+        "timestamp": iso_now()
+    }), 500
 
 
 # ===================
 # Application Startup
 # ===================
 
+def run_production_server(**options):
+    """Serve the app with Gunicorn using gunicorn.conf.py plus overrides; returns False if Gunicorn is unavailable"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        return False
+
+    class StandaloneApplication(BaseApplication):
+        def load_config(self):
+            settings = runpy.run_path(GUNICORN_CONFIG_FILE)
+            settings.update(options)
+            for key, value in settings.items():
+                if key in self.cfg.settings and value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    StandaloneApplication().run()
+    return True
+
+
 if __name__ == '__main__':
     # Ensure log directory exists
     os.makedirs('logs', exist_ok=True)
 
     # Development environment configuration
-    debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
     port = int(os.getenv('PORT', 5001))
     host = os.getenv('HOST', '0.0.0.0')
 
-    logger.info(f"Starting 1Cyber Equipment Repair Integration v1.3.0 - Debug: {debug_mode}, Port: {port}")
+    logger.info(f"Starting 1Cyber Equipment Repair Integration v1.3.0 - Debug: {DEBUG_MODE}, Port: {port}")
     logger.info(
         f"Freshdesk configuration: Domain={FRESHDESK_DOMAIN}, API Key={'configured' if FRESHDESK_API_KEY else 'not configured'}")
     logger.info(f"WordPress Form ID: {WP_FORM_ID}, Site URL: {WP_SITE_URL}")
     logger.info("✅ Simplified password field mapping with direct display enabled")
 
-    # Start application
-    app.run(debug=debug_mode, host=host, port=port)
\ No newline at end of file
+    # Flask's server is only used for development, or where Gunicorn isn't available (e.g. Windows)
+    if FLASK_ENV == 'development' or DEBUG_MODE or not run_production_server(bind=f"{host}:{port}"):
+        app.run(debug=DEBUG_MODE, host=host, port=port, threaded=True)
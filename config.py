@@ -1,4 +1,6 @@
+import base64
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # 加载.env文件
@@ -65,18 +67,21 @@ class Config:
 
         return True
 
+    # 配置在进程生命周期内不变，以下结果按配置类缓存
     @classmethod
+    @lru_cache(maxsize=None)
     def get_freshdesk_auth_header(cls):
         """获取Freshdesk认证头"""
-        import base64
         return base64.b64encode(f"{cls.FRESHDESK_API_KEY}:X".encode()).decode()
 
     @classmethod
+    @lru_cache(maxsize=None)
     def is_xero_configured(cls):
         """检查Xero是否已配置"""
         return bool(cls.XERO_CLIENT_ID and cls.XERO_CLIENT_SECRET)
 
     @classmethod
+    @lru_cache(maxsize=None)
     def is_email_configured(cls):
         """检查邮件是否已配置"""
         return bool(cls.SMTP_SERVER and cls.SMTP_USERNAME and cls.SMTP_PASSWORD)
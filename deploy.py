@@ -5,13 +5,49 @@
 """
 
 import os
+import re
 import sys
+import asyncio
+import hashlib
 import subprocess
 import shutil
+import string
+import tempfile
 import argparse
 from pathlib import Path
 from datetime import datetime
 
+try:
+    import win32file  # pywin32，仅Windows可用
+except ImportError:
+    win32file = None
+
+# 生产环境需要改写的 .env 配置项
+PRODUCTION_ENV_OVERRIDES = {
+    b'FLASK_ENV=development': b'FLASK_ENV=production',
+    b'FLASK_DEBUG=True': b'FLASK_DEBUG=False',
+    b'LOG_LEVEL=DEBUG': b'LOG_LEVEL=INFO'
+}
+_PRODUCTION_ENV_RE = re.compile(b'|'.join(map(re.escape, PRODUCTION_ENV_OVERRIDES)))
+
+# systemd 服务单元模板
+SYSTEMD_UNIT_TEMPLATE = string.Template("""[Unit]
+Description=Freshdesk Integration Service
+After=network.target
+
+[Service]
+Type=simple
+User=www-data
+WorkingDirectory=$root
+Environment=PATH=$root/venv/bin
+ExecStart=$root/venv/bin/python run.py --env production --no-debug
+Restart=always
+RestartSec=10
+
+[Install]
+WantedBy=multi-user.target
+""")
+
 
 class Deployer:
     def __init__(self, environment='production'):
@@ -25,26 +61,27 @@ class Deployer:
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         print(f"[{timestamp}] [{level}] {message}")
 
-    def run_command(self, command, check=True, capture_output=False):
-        """运行系统命令"""
+    async def run_command(self, argv, check=True, capture_output=False):
+        """运行系统命令（参数列表，不经过shell）"""
+        command = ' '.join(map(str, argv))
         self.log(f"执行命令: {command}")
 
+        stdout = asyncio.subprocess.PIPE if capture_output else None
         try:
-            if capture_output:
-                result = subprocess.run(
-                    command,
-                    shell=True,
-                    check=check,
-                    capture_output=True,
-                    text=True
-                )
-                return result.stdout.strip()
-            else:
-                subprocess.run(command, shell=True, check=check)
-                return True
-        except subprocess.CalledProcessError as e:
-            self.log(f"命令执行失败: {e}", 'ERROR')
+            proc = await asyncio.create_subprocess_exec(*map(str, argv), stdout=stdout)
+        except OSError as e:
+            self.log(f"命令无法执行: {e}", 'ERROR')
             return False
+        out, _ = await proc.communicate()
+
+        if proc.returncode != 0:
+            if check:
+                self.log(f"命令执行失败: {command} (返回码 {proc.returncode})", 'ERROR')
+            return False
+
+        if capture_output:
+            return out.decode().strip()
+        return True
 
     def check_prerequisites(self):
         """检查部署前提条件"""
@@ -65,17 +102,18 @@ class Deployer:
             'utils.py'
         ]
 
-        missing_files = []
-        for file in required_files:
-            if not (self.project_root / file).exists():
-                missing_files.append(file)
+        # 一次扫描项目目录，后续检查只做集合查找
+        with os.scandir(self.project_root) as entries:
+            present = {entry.name for entry in entries}
+
+        missing_files = [file for file in required_files if file not in present]
 
         if missing_files:
             self.log(f"缺少必需文件: {', '.join(missing_files)}", 'ERROR')
             return False
 
         # 检查环境变量文件
-        if not (self.project_root / '.env').exists():
+        if '.env' not in present:
             self.log("未找到.env文件，请从.env.example复制并配置", 'ERROR')
             return False
 
@@ -105,14 +143,87 @@ class Deployer:
             source = self.project_root / item
             if source.exists():
                 if source.is_file():
-                    shutil.copy2(source, backup_path)
+                    self._copy_file(source, backup_path / source.name, source.stat())
                 else:
-                    shutil.copytree(source, backup_path / item, dirs_exist_ok=True)
+                    self.copy_tree(source, backup_path / item)
 
         self.log(f"备份创建完成: {backup_path}")
         return backup_path
 
-    def setup_virtual_environment(self):
+    def copy_tree(self, source, dest):
+        """复制目录，优先使用系统工具（robocopy / cp -a --reflink=auto），不可用时回退到shutil"""
+        if os.name == 'nt':
+            if shutil.which('robocopy'):
+                result = subprocess.run(
+                    ['robocopy', str(source), str(dest), '/MT:64', '/E', '/NFL', '/NDL', '/SL'],
+                    check=False
+                )
+                # robocopy 返回码 0-3 表示成功，>=8 表示失败
+                if result.returncode < 4:
+                    return
+                self.log(f"robocopy 复制失败 (返回码 {result.returncode}): {source}", 'WARNING')
+        elif shutil.which('cp'):
+            dest.mkdir(parents=True, exist_ok=True)
+            result = subprocess.run(['cp', '-a', '--reflink=auto', f"{source}/.", str(dest)], check=False)
+            if result.returncode == 0:
+                return
+            # macOS 自带的 cp 不支持 --reflink
+            result = subprocess.run(['cp', '-a', f"{source}/.", str(dest)], check=False)
+            if result.returncode == 0:
+                return
+            self.log(f"cp 复制失败 (返回码 {result.returncode}): {source}", 'WARNING')
+
+        self._fast_copytree(source, dest)
+
+    def _fast_copytree(self, src, dst):
+        """基于 os.scandir 的目录复制，每个条目只取一次 stat"""
+        os.makedirs(dst, exist_ok=True)
+        with os.scandir(src) as entries:
+            for entry in entries:
+                target = os.path.join(dst, entry.name)
+                if entry.is_symlink():
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(os.readlink(entry.path), target)
+                elif entry.is_dir():
+                    self._fast_copytree(entry.path, target)
+                else:
+                    self._copy_file(entry.path, target, entry.stat())
+
+    def _copy_file(self, src, dst, st):
+        """复制单个文件并保留时间戳；Windows 下优先使用系统 CopyFile"""
+        if win32file is not None:
+            win32file.CopyFile(str(src), str(dst), False)
+        else:
+            try:
+                self._copy_file_range(src, dst, st.st_size)
+            except OSError:
+                # 跨设备 (EXDEV) 或内核/文件系统不支持时回退
+                shutil.copyfile(src, dst)
+            os.chmod(dst, st.st_mode)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _copy_file_range(self, src, dst, size):
+        """使用 os.copy_file_range 在内核中完成复制（Linux）"""
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError("copy_file_range 不可用")
+
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                remaining = size
+                while remaining > 0:
+                    sent = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if sent == 0:
+                        break
+                    remaining -= sent
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    async def setup_virtual_environment(self):
         """设置虚拟环境"""
         self.log("设置虚拟环境...")
 
@@ -121,7 +232,7 @@ class Deployer:
         # 创建虚拟环境（如果不存在）
         if not venv_path.exists():
             self.log("创建新虚拟环境...")
-            if not self.run_command(f"python3 -m venv {venv_path}"):
+            if not await self.run_command(['python3', '-m', 'venv', venv_path]):
                 return False
 
         # 激活虚拟环境并安装依赖
@@ -132,24 +243,32 @@ class Deployer:
             activate_script = venv_path / 'bin' / 'activate'
             pip_cmd = f"{venv_path}/bin/pip"
 
+        # requirements.txt 未变化时跳过 pip 安装
+        requirements_hash = hashlib.sha256((self.project_root / 'requirements.txt').read_bytes()).hexdigest()
+        hash_cache = venv_path / '.reqs.sha256'
+        if hash_cache.exists() and hash_cache.read_text().strip() == requirements_hash:
+            self.log("requirements.txt 未变化，跳过依赖安装")
+            return True
+
         # 升级pip
-        if not self.run_command(f"{pip_cmd} install --upgrade pip"):
+        if not await self.run_command([pip_cmd, 'install', '--upgrade', 'pip']):
             return False
 
         # 安装依赖
-        if not self.run_command(f"{pip_cmd} install -r requirements.txt"):
+        if not await self.run_command([pip_cmd, 'install', '-r', 'requirements.txt']):
             return False
 
+        hash_cache.write_text(requirements_hash)
         self.log("虚拟环境设置完成")
         return True
 
-    def run_tests(self):
+    async def run_tests(self):
         """运行测试"""
         self.log("运行部署前测试...")
 
         # 运行集成测试
-        test_result = self.run_command(
-            "python test_integration.py --quick",
+        test_result = await self.run_command(
+            ['python', 'test_integration.py', '--quick'],
             check=False
         )
 
@@ -160,7 +279,7 @@ class Deployer:
         self.log("测试通过")
         return True
 
-    def setup_systemd_service(self, service_name="freshdesk-integration"):
+    async def setup_systemd_service(self, service_name="freshdesk-integration"):
         """设置systemd服务（Linux）"""
         if os.name == 'nt':
             self.log("Windows系统跳过systemd配置")
@@ -168,32 +287,16 @@ class Deployer:
 
         self.log("配置systemd服务...")
 
-        service_content = f"""[Unit]
-Description=Freshdesk Integration Service
-After=network.target
-
-[Service]
-Type=simple
-User=www-data
-WorkingDirectory={self.project_root}
-Environment=PATH={self.project_root}/venv/bin
-ExecStart={self.project_root}/venv/bin/python run.py --env production --no-debug
-Restart=always
-RestartSec=10
-
-[Install]
-WantedBy=multi-user.target
-"""
+        service_content = SYSTEMD_UNIT_TEMPLATE.substitute(root=self.project_root)
 
         service_file = f"/etc/systemd/system/{service_name}.service"
 
         try:
-            with open(service_file, 'w') as f:
-                f.write(service_content)
+            self.write_file_atomic(service_file, service_content)
 
             # 重新加载systemd配置
-            self.run_command("systemctl daemon-reload")
-            self.run_command(f"systemctl enable {service_name}")
+            await self.run_command(['systemctl', 'daemon-reload'])
+            await self.run_command(['systemctl', 'enable', service_name])
 
             self.log(f"Systemd服务配置完成: {service_name}")
             return True
@@ -205,6 +308,18 @@ WantedBy=multi-user.target
             print(service_content)
             return False
 
+    def write_file_atomic(self, path, content, mode=0o644):
+        """先写入同目录临时文件再 os.replace，避免中断时留下写了一半的文件"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
     def setup_nginx_config(self):
         """设置Nginx配置"""
         self.log("生成Nginx配置...")
@@ -279,14 +394,14 @@ server {
 
         if not prod_env_path.exists():
             # 从.env复制并修改
-            env_content = (self.project_root / '.env').read_text()
+            env_content = (self.project_root / '.env').read_bytes()
 
-            # 修改关键配置
-            env_content = env_content.replace('FLASK_ENV=development', 'FLASK_ENV=production')
-            env_content = env_content.replace('FLASK_DEBUG=True', 'FLASK_DEBUG=False')
-            env_content = env_content.replace('LOG_LEVEL=DEBUG', 'LOG_LEVEL=INFO')
+            # 修改关键配置（单次扫描完成全部替换）
+            env_content = _PRODUCTION_ENV_RE.sub(
+                lambda m: PRODUCTION_ENV_OVERRIDES[m.group(0)], env_content
+            )
 
-            prod_env_path.write_text(env_content)
+            prod_env_path.write_bytes(env_content)
             self.log(f"生产环境配置已创建: {prod_env_path}")
 
         # 设置目录权限
@@ -295,27 +410,29 @@ server {
 
         return True
 
-    def deploy(self, skip_tests=False, skip_backup=False):
+    async def deploy(self, skip_tests=False, skip_backup=False):
         """执行部署"""
         self.log(f"开始部署到 {self.environment} 环境...")
+        loop = asyncio.get_running_loop()
 
         # 检查前提条件
         if not self.check_prerequisites():
             self.log("前提条件检查失败，部署终止", 'ERROR')
             return False
 
-        # 创建备份
+        # 备份与虚拟环境设置互不依赖，并发执行
+        steps = [self.setup_virtual_environment()]
         if not skip_backup:
-            backup_path = self.create_backup()
+            steps.append(loop.run_in_executor(None, self.create_backup))
 
-        # 设置虚拟环境
-        if not self.setup_virtual_environment():
+        venv_ok, *_ = await asyncio.gather(*steps)
+        if not venv_ok:
             self.log("虚拟环境设置失败", 'ERROR')
             return False
 
-        # 运行测试
+        # 运行测试（依赖虚拟环境）
         if not skip_tests:
-            if not self.run_tests():
+            if not await self.run_tests():
                 response = input("测试失败，是否继续部署? (y/N): ")
                 if response.lower() != 'y':
                     self.log("部署取消")
@@ -324,8 +441,10 @@ server {
         # 生产环境特定配置
         if self.environment == 'production':
             self.setup_production_env()
-            self.setup_systemd_service()
-            self.setup_nginx_config()
+            await asyncio.gather(
+                self.setup_systemd_service(),
+                loop.run_in_executor(None, self.setup_nginx_config)
+            )
 
         self.log("部署完成！")
 
@@ -384,10 +503,10 @@ def main():
             return
 
     # 执行部署
-    success = deployer.deploy(
+    success = asyncio.run(deployer.deploy(
         skip_tests=args.skip_tests,
         skip_backup=args.skip_backup
-    )
+    ))
 
     if success:
         print("🎉 部署成功！")
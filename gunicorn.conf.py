@@ -0,0 +1,34 @@
+"""
+Gunicorn 配置文件
+以多线程 worker 运行 Flask 应用，等待 Freshdesk/Xero 响应的 webhook 请求不会独占整个进程
+用法: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+# 绑定地址
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5001')}"
+
+# Worker 配置 - 默认 2 * CPU + 1 个进程
+workers = int(os.getenv('GUNICORN_WORKERS', 2 * multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+worker_connections = 1000
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+keepalive = 5
+
+# worker 心跳文件放在内存文件系统上，避免磁盘 I/O 导致的误判超时
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# 在 master 中预加载应用，编译好的正则、HTTP 会话等模块级对象通过 fork 共享给各 worker
+preload_app = True
+
+# 定期重启 worker 防止内存缓慢增长，jitter 避免所有 worker 同时重启
+max_requests = 1000
+max_requests_jitter = 100
+
+# 日志输出到标准输出，由 systemd/docker 收集
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'INFO').lower()
@@ -7,12 +7,19 @@ Flask 应用启动脚本
 import os
 import sys
 import argparse
+import requests
+from requests.adapters import HTTPAdapter
 from config import Config, config
 from utils import setup_logging
 
+# 复用连接池，避免每次请求重新握手
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
 
 def create_app(config_name=None):
     """创建Flask应用实例"""
+    # app 在导入时读取 FLASK_ENV，必须在 main() 设置环境变量之后再导入
     from app import app
 
     # 设置配置
@@ -74,9 +81,6 @@ def test_connections():
     """测试外部服务连接"""
     print("\n测试外部服务连接...")
 
-    import requests
-    from config import Config
-
     # 测试Freshdesk连接
     try:
         url = f"https://{Config.FRESHDESK_DOMAIN}/api/v2/tickets?per_page=1"
@@ -84,7 +88,7 @@ def test_connections():
             "Authorization": f"Basic {Config.get_freshdesk_auth_header()}",
             "Content-Type": "application/json"
         }
-        response = requests.get(url, headers=headers, timeout=10)
+        response = SESSION.get(url, headers=headers, timeout=10)
 
         if response.status_code == 200:
             print("✓ Freshdesk API连接成功")
@@ -164,6 +168,12 @@ def main():
     print("按 Ctrl+C 停止服务")
 
     try:
+        # 生产环境使用 Gunicorn（多 worker + SO_REUSEPORT），不可用时回退到 Flask 开发服务器
+        if args.env == 'production' and not debug_mode:
+            from app import run_production_server
+            if run_production_server(bind=f"{args.host}:{args.port}", reuse_port=True):
+                return
+
         # 启动应用
         app.run(
             host=args.host,
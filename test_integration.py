@@ -8,12 +8,16 @@ import os
 import sys
 import json
 import time
-import requests
+import threading
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from dotenv import load_dotenv
 
-# 加载环境变量
-load_dotenv()
+# 逐条追加的测试结果文件
+NDJSON_REPORT_FILE = 'logs/test_report.ndjson'
 
 
 class IntegrationTester:
@@ -21,6 +25,36 @@ class IntegrationTester:
         self.base_url = f"http://{os.getenv('HOST', 'localhost')}:{os.getenv('PORT', 5000)}"
         self.test_results = []
 
+        # 每条测试结果立即追加到 NDJSON 文件，脚本中途崩溃也不会丢失已完成的结果；
+        # 每次运行开始时清空文件，避免与之前运行的结果混在一起
+        self._report_lock = threading.Lock()
+        try:
+            os.makedirs('logs', exist_ok=True)
+            self._report_fh = open(NDJSON_REPORT_FILE, 'wb')
+        except OSError as e:
+            print(f"⚠️  无法打开测试结果文件: {str(e)}")
+            self._report_fh = None
+
+        # requests 在此延迟导入，--help 等场景无需加载
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # 共享连接池，避免每个请求重新建立TCP连接
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # 测试启动的最小间隔（秒），仅在间隔不足时等待，避免请求过快
+        self._min_interval = 0.1
+        self._last = 0.0
+        self._throttle_lock = threading.Lock()
+
     def log_test(self, test_name, success, message="", details=None):
         """记录测试结果"""
         result = {
@@ -31,6 +65,7 @@ class IntegrationTester:
             "timestamp": datetime.now().isoformat()
         }
         self.test_results.append(result)
+        self._append_result(result)
 
         status = "✅ PASS" if success else "❌ FAIL"
         print(f"{status} {test_name}: {message}")
@@ -38,6 +73,27 @@ class IntegrationTester:
         if details and not success:
             print(f"   详情: {details}")
 
+    def _append_result(self, result):
+        """追加一行测试结果到 NDJSON 文件"""
+        if self._report_fh is None:
+            return
+        if orjson is not None:
+            line = orjson.dumps(result, default=str) + b'\n'
+        else:
+            line = (json.dumps(result, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        with self._report_lock:
+            self._report_fh.write(line)
+            self._report_fh.flush()
+
+    def _throttled(self, test_func):
+        """按最小间隔错开测试启动后执行测试"""
+        with self._throttle_lock:
+            delay = self._min_interval - (time.monotonic() - self._last)
+            if delay > 0:
+                time.sleep(delay)
+            self._last = time.monotonic()
+        return test_func()
+
     def test_environment_variables(self):
         """测试环境变量配置"""
         print("\n🔍 测试环境变量配置...")
@@ -67,9 +123,10 @@ class IntegrationTester:
     def test_app_startup(self):
         """测试应用启动"""
         print("\n🚀 测试应用连接...")
+        import requests
 
         try:
-            response = requests.get(f"{self.base_url}/health", timeout=10)
+            response = self.session.get(f"{self.base_url}/health", timeout=10)
 
             if response.status_code == 200:
                 data = response.json()
@@ -104,7 +161,7 @@ class IntegrationTester:
         print("\n🎫 测试Freshdesk连接...")
 
         try:
-            response = requests.get(f"{self.base_url}/test/connection", timeout=15)
+            response = self.session.get(f"{self.base_url}/test/connection", timeout=15)
 
             if response.status_code == 200:
                 data = response.json()
@@ -156,7 +213,7 @@ class IntegrationTester:
         }
 
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/webhook/wordpress",
                 json=test_data,
                 headers={'Content-Type': 'application/json'},
@@ -211,7 +268,7 @@ class IntegrationTester:
             return False
 
         try:
-            response = requests.get(f"{self.base_url}/test/connection", timeout=10)
+            response = self.session.get(f"{self.base_url}/test/connection", timeout=10)
 
             if response.status_code == 200:
                 data = response.json()
@@ -252,37 +309,74 @@ class IntegrationTester:
 
         all_passed = True
 
-        for method, endpoint, name in endpoints:
-            try:
-                if method == 'GET':
-                    response = requests.get(f"{self.base_url}{endpoint}", timeout=10)
-                else:
-                    response = requests.request(method, f"{self.base_url}{endpoint}", timeout=10)
+        # 优先通过 /health/all 一次取得所有端点状态；服务端未覆盖的端点再并发单独请求
+        status_codes = self._fetch_health_all()
+        pending = [(method, endpoint) for method, endpoint, _ in endpoints if endpoint not in status_codes]
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = {
+                    endpoint: executor.submit(self.session.request, method, f"{self.base_url}{endpoint}", timeout=10)
+                    for method, endpoint in pending
+                }
+            for endpoint, future in futures.items():
+                try:
+                    status_codes[endpoint] = future.result().status_code
+                except Exception as e:
+                    status_codes[endpoint] = e
 
-                if response.status_code in [200, 302]:  # 302 for redirects
-                    self.log_test(f"API端点 {name}", True, f"{method} {endpoint} - HTTP {response.status_code}")
-                else:
-                    self.log_test(f"API端点 {name}", False, f"{method} {endpoint} - HTTP {response.status_code}")
-                    all_passed = False
+        for method, endpoint, name in endpoints:
+            status_code = status_codes[endpoint]
 
-            except Exception as e:
-                self.log_test(f"API端点 {name}", False, f"请求错误: {str(e)}")
+            if isinstance(status_code, Exception):
+                self.log_test(f"API端点 {name}", False, f"请求错误: {str(status_code)}")
+                all_passed = False
+            elif status_code in [200, 302]:  # 302 for redirects
+                self.log_test(f"API端点 {name}", True, f"{method} {endpoint} - HTTP {status_code}")
+            else:
+                self.log_test(f"API端点 {name}", False, f"{method} {endpoint} - HTTP {status_code}")
                 all_passed = False
 
         return all_passed
 
+    def _fetch_health_all(self):
+        """获取服务端聚合的端点状态 {路径: 状态码}，服务不支持时返回空字典"""
+        try:
+            response = self.session.get(f"{self.base_url}/health/all", timeout=30)
+            if response.status_code != 200:
+                return {}
+            return {
+                endpoint: result['status_code']
+                for endpoint, result in response.json().get('endpoints', {}).items()
+            }
+        except Exception:
+            return {}
+
     def test_security_features(self):
         """测试安全功能"""
         print("\n🔒 测试安全功能...")
 
-        # 测试无效JSON的处理
-        try:
-            response = requests.post(
-                f"{self.base_url}/webhook/wordpress",
+        url = f"{self.base_url}/webhook/wordpress"
+
+        # 两个异常请求互不依赖，同时发出
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # 测试无效JSON的处理
+            invalid_json = executor.submit(
+                self.session.post,
+                url,
                 data="invalid json",
                 headers={'Content-Type': 'application/json'},
                 timeout=10
             )
+            # 测试缺少必需字段的处理
+            missing_fields = executor.submit(
+                self.session.post,
+                url,
+                json={"incomplete": "data"},
+                timeout=10
+            )
+
+        try:
+            response = invalid_json.result()
 
             if response.status_code == 400:
                 self.log_test("安全 - 无效JSON处理", True, "正确拒绝无效JSON")
@@ -292,13 +386,8 @@ class IntegrationTester:
         except Exception as e:
             self.log_test("安全 - 无效JSON处理", False, f"测试错误: {str(e)}")
 
-        # 测试缺少必需字段的处理
         try:
-            response = requests.post(
-                f"{self.base_url}/webhook/wordpress",
-                json={"incomplete": "data"},
-                timeout=10
-            )
+            response = missing_fields.result()
 
             if response.status_code == 400:
                 self.log_test("安全 - 字段验证", True, "正确验证必需字段")
@@ -313,9 +402,8 @@ class IntegrationTester:
         print("🧪 开始集成测试...\n")
         print("=" * 60)
 
-        # 按顺序运行测试
-        tests = [
-            self.test_environment_variables,
+        # 环境变量检查先同步执行，其余测试互不依赖，并发执行
+        independent_tests = [
             self.test_app_startup,
             self.test_freshdesk_connection,
             self.test_api_endpoints,
@@ -325,15 +413,19 @@ class IntegrationTester:
         ]
 
         passed_tests = 0
-        total_tests = len(tests)
+        total_tests = len(independent_tests) + 1
+
+        if self.test_environment_variables():
+            passed_tests += 1
 
-        for test_func in tests:
-            try:
-                if test_func():
-                    passed_tests += 1
-                time.sleep(1)  # 避免请求过快
-            except Exception as e:
-                print(f"❌ 测试执行错误: {str(e)}")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {executor.submit(self._throttled, fn): fn.__name__ for fn in independent_tests}
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        passed_tests += 1
+                except Exception as e:
+                    print(f"❌ 测试执行错误 ({futures[future]}): {str(e)}")
 
         print("\n" + "=" * 60)
         print("📊 测试报告")
@@ -362,7 +454,11 @@ class IntegrationTester:
         return success_rate >= 80
 
     def save_test_report(self):
-        """保存测试报告"""
+        """保存测试摘要（逐条结果已写入 NDJSON 文件）"""
+        if self._report_fh is not None:
+            self._report_fh.close()
+            self._report_fh = None
+
         try:
             os.makedirs('logs', exist_ok=True)
 
@@ -373,13 +469,17 @@ class IntegrationTester:
                     "passed": sum(1 for r in self.test_results if r['success']),
                     "failed": sum(1 for r in self.test_results if not r['success'])
                 },
-                "results": self.test_results
+                "results_file": NDJSON_REPORT_FILE
             }
 
-            with open('logs/test_report.json', 'w', encoding='utf-8') as f:
-                json.dump(report, f, indent=2, ensure_ascii=False)
+            if orjson is not None:
+                with open('logs/test_report.json', 'wb') as f:
+                    f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+            else:
+                with open('logs/test_report.json', 'w', encoding='utf-8') as f:
+                    json.dump(report, f, indent=2, ensure_ascii=False)
 
-            print(f"\n📄 测试报告已保存: logs/test_report.json")
+            print(f"\n📄 测试报告已保存: logs/test_report.json (详细结果: {NDJSON_REPORT_FILE})")
 
         except Exception as e:
             print(f"⚠️  保存测试报告失败: {str(e)}")
@@ -396,6 +496,10 @@ def main():
 
     args = parser.parse_args()
 
+    # 加载环境变量（解析参数之后，--help 无需加载 dotenv）
+    from dotenv import load_dotenv
+    load_dotenv()
+
     # 检查应用是否在运行
     tester = IntegrationTester()
 
@@ -1,14 +1,26 @@
 import os
+import re
+import queue
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener, MemoryHandler
 import smtplib
-import hashlib
 import hmac
-import json
+import orjson
+import time
+import threading
 from datetime import datetime
+from functools import lru_cache
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from config import Config
 
+# 邮箱格式（模块加载时编译一次）；用 \Z 而非 $，末尾带换行符的输入不会通过
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\Z')
+
+# 默认需要遮盖的敏感字段（小写）
+_DEFAULT_SENSITIVE = frozenset({'password', 'api_key', 'token', 'secret', 'authorization'})
+
 
 def setup_logging():
     """设置日志配置"""
@@ -17,75 +29,152 @@ def setup_logging():
     if log_dir:
         os.makedirs(log_dir, exist_ok=True)
 
+    level = getattr(logging, Config.LOG_LEVEL, logging.INFO)
+
     # 配置日志格式
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s'
     )
 
-    # 文件处理器
-    file_handler = logging.FileHandler(Config.LOG_FILE, encoding='utf-8')
+    # 文件处理器，经 MemoryHandler 缓冲后批量写入（满200条或出现ERROR时刷新）
+    file_handler = logging.FileHandler(Config.LOG_FILE, encoding='utf-8', delay=True)
     file_handler.setFormatter(formatter)
-    file_handler.setLevel(getattr(logging, Config.LOG_LEVEL))
+    buffered_file_handler = MemoryHandler(capacity=200, flushLevel=logging.ERROR, target=file_handler)
+    buffered_file_handler.setLevel(level)
 
     # 控制台处理器
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
     console_handler.setLevel(logging.INFO)
 
+    # 实际写入由后台线程完成，请求线程只负责入队
+    queue_handler = QueueHandler(queue.Queue(-1))
+    listener = None
+
+    def _start_listener():
+        """启动（或在 fork 出的 worker 中重新启动）消费日志队列的后台线程"""
+        nonlocal listener
+        listener = QueueListener(queue_handler.queue, buffered_file_handler, console_handler,
+                                 respect_handler_level=True)
+        listener.start()
+
+    def _restart_listener_in_child():
+        # 监听线程不会随 fork 复制到子进程，需换用新队列并重新启动；
+        # 继承来的缓冲记录由父进程负责写入，子进程丢弃以免重复
+        buffered_file_handler.buffer = []
+        queue_handler.queue = queue.Queue(-1)
+        _start_listener()
+
+    _start_listener()
+    # atexit 按注册的逆序执行：先停止监听线程处理完队列，再刷新缓冲写入文件
+    atexit.register(buffered_file_handler.close)
+    atexit.register(lambda: listener.stop())
+    # Gunicorn preload_app 下在 master 中初始化，worker 需各自启动监听线程
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_listener_in_child)
+
     # 配置根日志器
     root_logger = logging.getLogger()
-    root_logger.setLevel(getattr(logging, Config.LOG_LEVEL))
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_handler)
 
     return root_logger
 
 
+@lru_cache(maxsize=16)
+def _utf8(s):
+    """缓存配置类字符串（密钥等）的UTF-8编码结果"""
+    return s.encode('utf-8')
+
+
 def verify_webhook_signature(payload, signature, secret):
     """验证webhook签名"""
     if not secret:
         return True
 
-    expected_signature = hmac.new(
-        secret.encode(),
-        payload,
-        hashlib.sha256
-    ).hexdigest()
+    # 签名可能带有 "sha256=" 前缀；按原始字节比较（32字节而不是64个十六进制字符）
+    if signature and signature.startswith('sha256='):
+        signature = signature[7:]
+    try:
+        signature_bytes = bytes.fromhex(signature)
+    except (TypeError, ValueError):
+        return False
+
+    expected_signature = hmac.digest(_utf8(secret), payload, 'sha256')
 
-    return hmac.compare_digest(signature, expected_signature)
+    return hmac.compare_digest(signature_bytes, expected_signature)
 
 
 def sanitize_input(data, max_length=None):
     """清理输入数据"""
-    if isinstance(data, str):
-        # 移除潜在的恶意字符
-        sanitized = data.strip()
-        if max_length:
-            sanitized = sanitized[:max_length]
-        return sanitized
-    elif isinstance(data, dict):
-        return {k: sanitize_input(v, max_length) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [sanitize_input(item, max_length) for item in data]
-    else:
-        return data
+    # 用显式栈代替递归，深层嵌套的数据不会触发 RecursionError
+    root = [data]
+    stack = [(root, 0, data)]
+    while stack:
+        parent, key, value = stack.pop()
+        if isinstance(value, str):
+            # 移除潜在的恶意字符（首尾无空白时不调用 strip，避免复制字符串）
+            sanitized = value
+            if value[:1].isspace() or value[-1:].isspace():
+                sanitized = value.strip()
+            if max_length and len(sanitized) > max_length:
+                sanitized = sanitized[:max_length]
+            parent[key] = sanitized
+        elif isinstance(value, dict):
+            cleaned = dict.fromkeys(value)
+            parent[key] = cleaned
+            stack.extend((cleaned, k, v) for k, v in value.items())
+        elif isinstance(value, list):
+            cleaned = [None] * len(value)
+            parent[key] = cleaned
+            stack.extend((cleaned, i, v) for i, v in enumerate(value))
+        else:
+            parent[key] = value
+    return root[0]
 
 
 def validate_email(email):
     """验证邮箱格式"""
-    import re
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    return _EMAIL_RE.match(email) is not None
 
 
 def format_currency(amount, currency='CNY'):
     """格式化货币"""
+    # 已是数值时直接格式化，跳过 float() 转换
+    amount_type = type(amount)
+    if amount_type is float or amount_type is int:
+        return f"{amount:.2f} {currency}"
     try:
         return f"{float(amount):.2f} {currency}"
     except (ValueError, TypeError):
         return f"0.00 {currency}"
 
 
+_smtp_local = threading.local()
+
+
+def _get_smtp():
+    """获取当前线程复用的SMTP连接，首次使用时连接并登录"""
+    conn = getattr(_smtp_local, 'conn', None)
+    if conn is None:
+        conn = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
+        conn.starttls()
+        conn.login(Config.SMTP_USERNAME, Config.SMTP_PASSWORD)
+        _smtp_local.conn = conn
+    return conn
+
+
+def _reset_smtp():
+    """丢弃当前线程的SMTP连接"""
+    conn = getattr(_smtp_local, 'conn', None)
+    _smtp_local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 def send_email_notification(subject, message, to_email=None):
     """发送邮件通知"""
     if not Config.is_email_configured():
@@ -94,34 +183,51 @@ def send_email_notification(subject, message, to_email=None):
 
     try:
         # 创建邮件
-        msg = MimeMultipart()
+        msg = MIMEMultipart()
         msg['From'] = Config.SMTP_USERNAME
         msg['To'] = to_email or Config.NOTIFICATION_EMAIL
         msg['Subject'] = subject
 
         # 添加邮件正文
-        msg.attach(MimeText(message, 'plain', 'utf-8'))
+        msg.attach(MIMEText(message, 'plain', 'utf-8'))
 
-        # 连接SMTP服务器并发送
-        with smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT) as server:
-            server.starttls()
-            server.login(Config.SMTP_USERNAME, Config.SMTP_PASSWORD)
-            server.send_message(msg)
+        # 复用已建立的SMTP连接发送；连接失效时重连并重试一次
+        try:
+            _get_smtp().send_message(msg)
+        except (smtplib.SMTPException, OSError):
+            _reset_smtp()
+            _get_smtp().send_message(msg)
 
         logging.info(f"邮件通知已发送: {subject}")
         return True
 
     except Exception as e:
+        _reset_smtp()
         logging.error(f"发送邮件通知失败: {str(e)}")
         return False
 
 
+@lru_cache(maxsize=1)
+def _iso_second(second):
+    return datetime.fromtimestamp(second).isoformat()
+
+
+@lru_cache(maxsize=1)
+def _reference_second(second):
+    return datetime.fromtimestamp(second).strftime("%Y%m%d%H%M%S")
+
+
+def _iso_now():
+    """本地时间ISO时间戳（秒级精度），每秒最多格式化一次"""
+    return _iso_second(int(time.time()))
+
+
 def create_error_response(message, status_code=400, details=None):
     """创建标准错误响应"""
     response = {
         "error": message,
         "status_code": status_code,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _iso_now()
     }
 
     if details:
@@ -135,7 +241,7 @@ def create_success_response(message, data=None):
     response = {
         "status": "success",
         "message": message,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _iso_now()
     }
 
     if data:
@@ -144,65 +250,120 @@ def create_success_response(message, data=None):
     return response
 
 
+class _LazyJson:
+    """仅在日志真正被格式化时才序列化为JSON"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return orjson.dumps(self.data, default=str).decode()
+
+
 def log_api_request(request, response_status=None):
     """记录API请求日志"""
     logger = logging.getLogger(__name__)
+    if not logger.isEnabledFor(logging.INFO):
+        return
 
     request_data = {
         "method": request.method,
         "url": request.url,
-        "headers": dict(request.headers),
+        # 复制请求头时直接遮盖敏感信息
+        "headers": {k: ("[REDACTED]" if k == 'Authorization' else v) for k, v in request.headers.items()},
         "remote_addr": request.remote_addr,
         "user_agent": request.headers.get('User-Agent'),
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _iso_now()
     }
 
     if response_status:
         request_data["response_status"] = response_status
 
-    # 移除敏感信息
-    if 'Authorization' in request_data["headers"]:
-        request_data["headers"]["Authorization"] = "[REDACTED]"
+    logger.info("API请求: %s", _LazyJson(request_data))
+
 
-    logger.info(f"API请求: {json.dumps(request_data, ensure_ascii=False)}")
+@lru_cache(maxsize=8)
+def _mask_re(keys):
+    """把敏感字段集合编译为一个正则（子串匹配），按集合缓存"""
+    if not keys:
+        return None
+    return re.compile('|'.join(map(re.escape, keys)))
 
 
 def mask_sensitive_data(data, keys_to_mask=None):
     """遮盖敏感数据"""
     if keys_to_mask is None:
-        keys_to_mask = ['password', 'api_key', 'token', 'secret', 'authorization']
-
-    if isinstance(data, dict):
-        masked_data = {}
-        for key, value in data.items():
-            if any(sensitive_key in key.lower() for sensitive_key in keys_to_mask):
-                masked_data[key] = "[REDACTED]"
-            elif isinstance(value, (dict, list)):
-                masked_data[key] = mask_sensitive_data(value, keys_to_mask)
-            else:
-                masked_data[key] = value
-        return masked_data
-    elif isinstance(data, list):
-        return [mask_sensitive_data(item, keys_to_mask) for item in data]
+        keys_to_mask = _DEFAULT_SENSITIVE
     else:
-        return data
+        keys_to_mask = frozenset(k.lower() for k in keys_to_mask)
+    pattern = _mask_re(keys_to_mask)
+
+    # 用显式栈代替递归，深层嵌套的数据不会触发 RecursionError
+    root = [data]
+    stack = [(root, 0, data)]
+    while stack:
+        parent, key, value = stack.pop()
+        if isinstance(value, dict):
+            masked_data = dict.fromkeys(value)
+            parent[key] = masked_data
+            for k, v in value.items():
+                key_l = k.lower()
+                # 精确匹配走集合查找，其余情况用一次正则扫描做子串匹配
+                if key_l in keys_to_mask or (pattern is not None and pattern.search(key_l)):
+                    masked_data[k] = "[REDACTED]"
+                else:
+                    stack.append((masked_data, k, v))
+        elif isinstance(value, list):
+            masked_list = [None] * len(value)
+            parent[key] = masked_list
+            stack.extend((masked_list, i, v) for i, v in enumerate(value))
+        else:
+            parent[key] = value
+    return root[0]
 
 
 def generate_reference_number(prefix="REF"):
     """生成参考号"""
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    return f"{prefix}-{timestamp}"
+    return f"{prefix}-{_reference_second(int(time.time()))}"
+
+
+_DATETIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+    "%d-%m-%Y"
+)
+
+
+def _parse_iso(datetime_str):
+    """用 C 实现的 datetime.fromisoformat 解析前三种 ISO 格式，不匹配时返回 None"""
+    s = datetime_str
+    n = len(s)
+    if n < 10 or s[4] != '-' or s[7] != '-':
+        return None
+    if n == 10 or (n == 20 and s[10] == 'T' and s[19] == 'Z') or (n == 19 and s[10] == ' '):
+        if n > 10 and (s[13] != ':' or s[16] != ':'):
+            return None
+        try:
+            return datetime.fromisoformat(s[:19])
+        except ValueError:
+            return None
+    return None
 
 
 def parse_datetime(datetime_str):
     """解析日期时间字符串"""
-    formats = [
-        "%Y-%m-%dT%H:%M:%SZ",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y-%m-%d",
-        "%d/%m/%Y",
-        "%d-%m-%Y"
-    ]
+    parsed = _parse_iso(datetime_str)
+    if parsed is not None:
+        return parsed
+
+    # 根据分隔符先尝试最可能的格式
+    if '/' in datetime_str:
+        formats = ("%d/%m/%Y",) + _DATETIME_FORMATS
+    else:
+        formats = _DATETIME_FORMATS
 
     for fmt in formats:
         try:
@@ -213,56 +374,67 @@ def parse_datetime(datetime_str):
     raise ValueError(f"无法解析日期时间: {datetime_str}")
 
 
-def validate_freshdesk_data(data):
-    """验证Freshdesk数据"""
-    required_fields = ['email', 'subject']
-    errors = []
+# 数据校验规则：必需字段（按报错顺序）、是否校验邮箱、优先级取值
+_FRESHDESK_SCHEMA = {'required': ('email', 'subject'), 'email': True, 'priorities': (1, 2, 3, 4)}
+_XERO_SCHEMA = {'required': ('amount',), 'email': False}
+_WORDPRESS_SCHEMA = {'required': ('email', 'subject', 'message'), 'email': True}
+# WordPress表单字段长度上限：(字段, 最大长度, 错误信息)
+_WP_LIMITS = (
+    ('subject', 100, "主题长度不能超过100字符"),
+    ('message', 5000, "消息长度不能超过5000字符")
+)
+
 
-    for field in required_fields:
-        if not data.get(field):
-            errors.append(f"缺少必需字段: {field}")
+def _validate_schema(data, schema):
+    """按校验规则检查必需字段、邮箱与优先级，只为出错的字段生成错误信息"""
+    errors = [f"缺少必需字段: {field}" for field in schema['required'] if not data.get(field)]
 
-    # 验证邮箱
-    if data.get('email') and not validate_email(data['email']):
-        errors.append("邮箱格式无效")
+    if schema['email']:
+        email = data.get('email')
+        if email and not validate_email(email):
+            errors.append("邮箱格式无效")
 
-    # 验证优先级
-    if data.get('priority') and data['priority'] not in [1, 2, 3, 4]:
-        errors.append("优先级必须是1-4之间的数字")
+    priorities = schema.get('priorities')
+    if priorities:
+        priority = data.get('priority')
+        if priority and priority not in priorities:
+            errors.append("优先级必须是1-4之间的数字")
 
     return errors
 
 
+def validate_freshdesk_data(data):
+    """验证Freshdesk数据"""
+    return _validate_schema(data, _FRESHDESK_SCHEMA)
+
+
 def validate_xero_data(data):
     """验证Xero数据"""
-    required_fields = ['amount']
-    errors = []
+    errors = _validate_schema(data, _XERO_SCHEMA)
 
-    for field in required_fields:
-        if not data.get(field):
-            errors.append(f"缺少必需字段: {field}")
+    # 验证金额（已是数值时无需转换）
+    amount = data.get('amount', 0)
+    if not isinstance(amount, (int, float)):
+        try:
+            amount = float(amount)
+        except (ValueError, TypeError):
+            errors.append("金额格式无效")
+            return errors
 
-    # 验证金额
-    try:
-        amount = float(data.get('amount', 0))
-        if amount <= 0:
-            errors.append("金额必须大于0")
-    except (ValueError, TypeError):
-        errors.append("金额格式无效")
+    if amount <= 0:
+        errors.append("金额必须大于0")
 
     return errors
 
 
-def retry_api_call(func, max_retries=3, delay=1):
-    """重试API调用"""
-    import time
-
+def retry_api_call(func, max_retries=3, delay=1, exceptions=(Exception,)):
+    """重试API调用（仅对 exceptions 中的异常重试）"""
     for attempt in range(max_retries):
         try:
             return func()
-        except Exception as e:
+        except exceptions as e:
             if attempt == max_retries - 1:
-                raise e
+                raise
 
             logging.warning(f"API调用失败 (尝试 {attempt + 1}/{max_retries}): {str(e)}")
             time.sleep(delay * (attempt + 1))
@@ -272,22 +444,21 @@ def retry_api_call(func, max_retries=3, delay=1):
 
 def get_client_ip(request):
     """获取客户端IP地址"""
-    # 检查代理头
-    if request.headers.get('X-Forwarded-For'):
-        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
-    elif request.headers.get('X-Real-IP'):
-        return request.headers.get('X-Real-IP')
-    else:
-        return request.remote_addr
+    # 检查代理头（每个请求头只查找一次）
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.partition(',')[0].strip()
+
+    real_ip = request.headers.get('X-Real-IP')
+    return real_ip if real_ip else request.remote_addr
 
 
 def rate_limit_key(request, identifier=None):
     """生成速率限制键"""
     if identifier:
-        return f"rate_limit:{identifier}"
+        return "rate_limit:" + str(identifier)
     else:
-        ip = get_client_ip(request)
-        return f"rate_limit:{ip}"
+        return "rate_limit:" + str(get_client_ip(request))
 
 
 class DataValidator:
@@ -296,24 +467,14 @@ class DataValidator:
     @staticmethod
     def validate_wordpress_form(data):
         """验证WordPress表单数据"""
-        errors = []
-
-        # 必需字段
-        required_fields = ['email', 'subject', 'message']
-        for field in required_fields:
-            if not data.get(field):
-                errors.append(f"缺少必需字段: {field}")
-
-        # 邮箱验证
-        if data.get('email') and not validate_email(data['email']):
-            errors.append("邮箱格式无效")
+        # 必需字段与邮箱验证
+        errors = _validate_schema(data, _WORDPRESS_SCHEMA)
 
         # 长度验证
-        if data.get('subject') and len(data['subject']) > 100:
-            errors.append("主题长度不能超过100字符")
-
-        if data.get('message') and len(data['message']) > 5000:
-            errors.append("消息长度不能超过5000字符")
+        for field, limit, message in _WP_LIMITS:
+            value = data.get(field)
+            if value and len(value) > limit:
+                errors.append(message)
 
         return errors
 